@@ -18,10 +18,11 @@ class ProfileManager(models.Manager):
 class Profile(models.Model):
     user = models.OneToOneField(to=User, on_delete=models.CASCADE)
     timezone = models.CharField(max_length=254, default="UTC")
+    sort = models.CharField(max_length=20, default="created")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    object = ProfileManager()
+    objects = ProfileManager()
 
     class Meta:
         verbose_name = "Profile"
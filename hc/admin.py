@@ -1,20 +1,149 @@
+import json
+from hashlib import md5
+from uuid import UUID
+
 from django.contrib import admin
-from django.contrib import admin
+from django.contrib.admin.utils import get_fields_from_path
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
 from django.core.paginator import Paginator
-from django.db import connection
-from django.db.models import Count, F
+from django.db import DatabaseError, connection
+from django.db.models import F, Q
 from django.urls import reverse
+from django.utils.functional import cached_property
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
+from django.utils.text import smart_split, unescape_string_literal
 from hc.models import Channel, Check, Notification, Ping
 
 
 # Register your models here.
 
 
+class EstimatedCountPaginator(Paginator):
+    """ A paginator that estimates the size of large change lists.
+
+    An exact COUNT(*) reads every matching row. On PostgreSQL, the
+    planner's row estimate for the (possibly filtered) queryset is used
+    instead, unless it is below `threshold`, in which case the rows are
+    counted exactly. Other databases count at most `threshold` rows, so
+    pages past that point are not linked. Results are cached for
+    `cache_ttl` seconds.
+    """
+
+    threshold = 10000
+    cache_ttl = 60
+
+    def _estimate(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def _count(self, q, sql, params):
+        if connection.vendor == "postgresql":
+            try:
+                estimate = self._estimate(sql, params)
+            except DatabaseError:
+                estimate = 0
+
+            if estimate >= self.threshold:
+                return estimate
+
+            return q.count()
+
+        return q[: self.threshold].count()
+
+    @cached_property
+    def count(self):
+        q = self.object_list
+        if not hasattr(q, "query"):
+            return len(q)
+
+        try:
+            sql, params = q.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+
+        key = "hc-count-%s" % md5(("%s %r" % (sql, params)).encode()).hexdigest()
+        result = cache.get(key)
+        if result is None:
+            result = self._count(q, sql, params)
+            cache.set(key, result, self.cache_ttl)
+
+        return result
+
+
+def project_link(obj):
+    """ Show the owner's email and a link to the project's checks.
+
+    Reads the `email` and `project_name` annotations of the row.
+    """
+
+    url = reverse("admin:hc_check_changelist")
+    url += "?project__id__exact=%d" % obj.project_id
+    name = escape(obj.project_name or "Default")
+    email = escape(obj.email)
+    return f'{email} &rsaquo; <a href="{url}">{name}</a>'
+
+
+class IndexedSearchMixin(object):
+    """ Admin search that PostgreSQL can answer from indexes.
+
+    The search string is split into words like the stock admin search
+    does, and every word has to match. A word that is a UUID only
+    matches the `code` search fields, exactly, through their unique
+    indexes. Any other word matches each search field with icontains in
+    a subquery on the field's own table, and a row matches the word if
+    any of those subqueries does. Each subquery can use the trigram
+    index the searchindexes command creates for its column, instead of
+    one ILIKE scan across all the joins.
+    """
+
+    def term_q(self, model, term):
+        try:
+            code = UUID(term)
+        except ValueError:
+            code = None
+
+        if code is not None:
+            fields = [f for f in self.search_fields if f.split("__")[-1] == "code"]
+            if fields:
+                q = Q()
+                for field in fields:
+                    q |= Q(**{field: code})
+                return q
+
+        q = Q()
+        for field in self.search_fields:
+            path, _, name = field.rpartition("__")
+            if not path:
+                q |= Q(**{name + "__icontains": term})
+                continue
+
+            related = get_fields_from_path(model, path)[-1].related_model
+            matches = related.objects.filter(**{name + "__icontains": term})
+            q |= Q(**{path + "__in": matches.values("pk")})
+
+        return q
+
+    def get_search_results(self, request, queryset, search_term):
+        # Like the stock admin search: every word has to match
+        for bit in smart_split(search_term):
+            if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+                bit = unescape_string_literal(bit)
+            queryset = queryset.filter(self.term_q(queryset.model, bit))
+
+        return queryset, False
+
+
 @admin.register(Check)
-class ChecksAdmin(admin.ModelAdmin):
-    search_fields = ["name", "code", "project__owner__email"]
+class ChecksAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    search_fields = ["name", "code", "project__owner__user__email"]
     raw_id_fields = ("project",)
     list_display = (
         "id",
@@ -29,26 +158,27 @@ class ChecksAdmin(admin.ModelAdmin):
     )
     list_filter = ("status", "kind", "last_ping", "last_start")
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
     actions = ["send_alert"]
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         qs = qs.annotate(project_name=F("project__name"))
+        qs = qs.annotate(email=F("project__owner__user__email"))
         return qs
 
     @mark_safe
     def project_(self, obj):
-        url = reverse("hc-checks", args=[obj.project.code])
-        name = escape(obj.project_name or "Default")
-        email = escape(obj.email)
-        return f'{email} &rsaquo; <a href="{url}"">{name}</a>'
+        return project_link(obj)
 
     @mark_safe
     def name_tags(self, obj):
-        url = reverse("hc-details", args=[obj.code])
+        url = reverse("admin:hc_check_change", args=[obj.id])
         name = escape(obj.name or "unnamed")
 
-        s = f'<a href="{url}"">{name}</a>'
+        s = f'<a href="{url}">{name}</a>'
         for tag in obj.tags_list():
             s += " <span>%s</span>" % escape(tag)
 
@@ -66,10 +196,9 @@ class ChecksAdmin(admin.ModelAdmin):
 
     def send_alert(self, request, qs):
         for check in qs:
-            for channel in check.channel_set.all():
-                channel.notify(check)
+            check.send_alert()
 
-        self.message_user(request, "%d alert(s) sent" % qs.count())
+        self.message_user(request, "%d alert(s) queued" % qs.count())
 
     send_alert.short_description = "Send Alert"
 
@@ -115,62 +244,31 @@ class KindListFilter(admin.SimpleListFilter):
         return queryset
 
 
-# Adapted from: https://djangosnippets.org/snippets/2593/
-class LargeTablePaginator(Paginator):
-    """ Overrides the count method to get an estimate instead of actual count
-    when not filtered
-    """
-
-    def _get_estimate(self):
-        try:
-            cursor = connection.cursor()
-            cursor.execute(
-                "SELECT reltuples FROM pg_class WHERE relname = %s",
-                [self.object_list.query.model._meta.db_table],
-            )
-            return int(cursor.fetchone()[0])
-        except:
-            return 0
-
-    def _get_count(self):
-        """
-        Changed to use an estimate if the estimate is greater than 10,000
-        Returns the total number of objects, across all pages.
-        """
-        if not hasattr(self, "_count") or self._count is None:
-            try:
-                estimate = 0
-                if not self.object_list.query.where:
-                    estimate = self._get_estimate()
-                if estimate < 10000:
-                    self._count = self.object_list.count()
-                else:
-                    self._count = estimate
-            except (AttributeError, TypeError):
-                # AttributeError if object_list has no count() method.
-                # TypeError if object_list.count() requires arguments
-                # (i.e. is of type list).
-                self._count = len(self.object_list)
-        return self._count
-
-    count = property(_get_count)
-
-
 @admin.register(Ping)
-class PingsAdmin(admin.ModelAdmin):
+class PingsAdmin(IndexedSearchMixin, admin.ModelAdmin):
     search_fields = ("owner__name", "owner__code")
-    readonly_fields = ("owner",)
+    readonly_fields = ("owner", "body_")
+    exclude = ("body",)
     list_select_related = ("owner",)
     list_display = ("id", "created_at", "owner", "scheme", "method", "ua")
     list_filter = ("created_at", SchemeListFilter, MethodListFilter, KindListFilter)
 
-    paginator = LargeTablePaginator
+    paginator = EstimatedCountPaginator
     show_full_result_count = False
 
+    def get_queryset(self, request):
+        # Bodies are only read on the detail page, when body_ accesses them
+        return super().get_queryset(request).defer("body", "body_raw")
+
+    def body_(self, obj):
+        return obj.get_body()
+
+    body_.short_description = "Body"
+
 
 @admin.register(Channel)
-class ChannelsAdmin(admin.ModelAdmin):
-    search_fields = ["value", "project__owner__email"]
+class ChannelsAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    search_fields = ["value", "project__owner__user__email"]
     list_display = (
         "id",
         "kind_",
@@ -182,18 +280,17 @@ class ChannelsAdmin(admin.ModelAdmin):
     list_filter = ("kind",)
     raw_id_fields = ("project", "checks")
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
     @mark_safe
     def project_(self, obj):
-        url = reverse("hc-checks", args=[obj.project_code])
-        name = escape(obj.project_name or "Default")
-        email = escape(obj.email)
-        return f"{email} &rsaquo; <a href='{url}'>{name}</a>"
+        return project_link(obj)
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        qs = qs.annotate(Count("notification", distinct=True))
-        qs = qs.annotate(project_code=F("project__code"))
         qs = qs.annotate(project_name=F("project__name"))
+        qs = qs.annotate(email=F("project__owner__user__email"))
         return qs
 
     @mark_safe
@@ -201,13 +298,14 @@ class ChannelsAdmin(admin.ModelAdmin):
         return f'<span class="icon-{obj.kind}"></span> &nbsp; {obj.kind}'
 
     def num_notifications(self, obj):
-        return obj.notification__count
+        return obj.notification_count
 
     num_notifications.short_description = "# Notifications"
+    num_notifications.admin_order_field = "notification_count"
 
 
 @admin.register(Notification)
-class NotificationsAdmin(admin.ModelAdmin):
+class NotificationsAdmin(IndexedSearchMixin, admin.ModelAdmin):
     search_fields = ["owner__name", "owner__code", "channel__value"]
     readonly_fields = ("owner",)
     list_select_related = ("owner", "channel")
@@ -223,6 +321,9 @@ class NotificationsAdmin(admin.ModelAdmin):
     list_filter = ("created_at", "check_status", "channel__kind")
     raw_id_fields = ("channel",)
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
     def channel_kind(self, obj):
         return obj.channel.kind
 
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class HcConfig(AppConfig):
     name = 'hc'
+
+    def ready(self):
+        # Registers the system checks
+        from hc import checks  # noqa: F401
+
+        # Connects the signal receivers that invalidate the ping
+        # registry, also in processes that never load the URLconf
+        from hc import registry  # noqa: F401
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import Profile, Project
+
+
+class BenchCommand(BaseCommand):
+    """ Base class of the benchmark commands that write to the database.
+
+    They refuse to run unless DEBUG is on or --force is given, so that
+    a production database doesn't get benchmark data by accident.
+    """
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Run even though DEBUG is off",
+        )
+        return parser
+
+    def execute(self, *args, **options):
+        if not settings.DEBUG and not options.get("force"):
+            raise CommandError(
+                "This benchmark creates and deletes rows in the configured "
+                "database. Run it with DEBUG on, or pass --force."
+            )
+
+        return super().execute(*args, **options)
+
+
+@contextmanager
+def scratch_project(name, **profile_fields):
+    """ Create a throwaway user and project, and delete them on the way out.
+
+    Deleting the user cascades to the project, its checks and their
+    pings, also when the benchmark fails or is interrupted.
+    """
+
+    user = User.objects.create(username="%s-%s" % (name, uuid4().hex[:8]))
+    try:
+        profile = Profile.objects.create(user=user, **profile_fields)
+        yield Project.objects.create(name=name, owner=profile)
+    finally:
+        user.delete()
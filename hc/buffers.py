@@ -0,0 +1,104 @@
+import atexit
+import logging
+import time
+from threading import Lock, Thread
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from hc import rollups
+from hc.metrics import metrics
+from hc.models import Check, Ping
+
+logger = logging.getLogger(__name__)
+
+
+class PingBuffer(object):
+    """ Collects Ping rows in memory and writes them with bulk_create.
+
+    The buffer is flushed when it holds `size` rows or when its oldest
+    row is `window` seconds old, whichever comes first. A background
+    thread takes care of the second case when traffic goes quiet, and
+    the buffer is also flushed on interpreter exit. Pings accepted
+    less than `window` seconds before a hard crash are lost.
+    """
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self.lock = Lock()
+        self.items = []
+        self.oldest = None
+        self.flusher = None
+
+    def add(self, ping):
+        if self.size <= 1:
+            self._write([ping])
+            return
+
+        with self.lock:
+            if not self.items:
+                self.oldest = time.monotonic()
+            self.items.append(ping)
+            full = len(self.items) >= self.size
+            self._start_flusher()
+
+        if full:
+            # Whatever goes wrong with the batch, this ping was accepted
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered pings")
+
+    def flush(self):
+        with self.lock:
+            batch, self.items = self.items, []
+            self.oldest = None
+
+        if batch:
+            self._write(batch)
+
+        return len(batch)
+
+    def _write(self, batch):
+        # Ping.count was set when the ping was counted, see Check.ping()
+        with metrics.timer("hc_ping_flush_seconds"):
+            try:
+                with transaction.atomic():
+                    Ping.objects.bulk_create(batch)
+            except IntegrityError:
+                # A check was deleted while its pings were buffered. Its
+                # pings go, the rest of the batch is written.
+                owners = {ping.owner_id for ping in batch}
+                ids = set(Check.objects.filter(id__in=owners).values_list("id", flat=True))
+                batch = [ping for ping in batch if ping.owner_id in ids]
+                Ping.objects.bulk_create(batch)
+
+            # In a transaction of its own, so failing here does not throw
+            # away the pings. The rebuildrollups command recounts them.
+            try:
+                with transaction.atomic():
+                    rollups.record_pings(batch)
+            except Exception:
+                logger.exception("Failed to add %d ping(s) to the rollups", len(batch))
+
+    def _start_flusher(self):
+        if self.flusher is None:
+            self.flusher = Thread(target=self._run, daemon=True)
+            self.flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            oldest = self.oldest
+            if oldest is None or time.monotonic() - oldest < self.window:
+                continue
+
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush buffered pings")
+
+
+pings = PingBuffer(settings.PING_BUFFER_SIZE, settings.PING_BUFFER_WINDOW)
+atexit.register(pings.flush)
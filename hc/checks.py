@@ -0,0 +1,20 @@
+from django.core.checks import Tags, Warning, register
+from hc.utils import cache_is_shared
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    if cache_is_shared():
+        return []
+
+    return [
+        Warning(
+            "The default cache is not shared between processes.",
+            hint=(
+                "Set CACHE_URL to a shared backend. Until then, every process "
+                "re-reads the site and check settings from the database every "
+                "few seconds, instead of only when they change."
+            ),
+            id="hc.W001",
+        )
+    ]
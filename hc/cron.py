@@ -0,0 +1,350 @@
+from bisect import bisect_right
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+import pytz
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+MONTH_NAMES = ("jan", "feb", "mar", "apr", "may", "jun")
+MONTH_NAMES += ("jul", "aug", "sep", "oct", "nov", "dec")
+DOW_NAMES = ("sun", "mon", "tue", "wed", "thu", "fri", "sat")
+
+# (lowest value, highest value, names starting at the lowest value)
+FIELDS = (
+    (0, 59, ()),
+    (0, 23, ()),
+    (1, 31, ()),
+    (1, 12, MONTH_NAMES),
+    (0, 7, DOW_NAMES),
+)
+
+# Longest gap between two fire times of a valid expression is a few
+# years (February 29 on a given weekday), this bounds the search loops.
+MAX_STEPS = 10000
+ONE_MINUTE = timedelta(minutes=1)
+ONE_DAY = timedelta(days=1)
+ZERO = timedelta()
+
+
+def _next_bit(mask, start):
+    """ Return the lowest set bit >= start, or None. """
+
+    m = mask >> start
+    if not m:
+        return None
+
+    return start + (m & -m).bit_length() - 1
+
+
+def _prev_bit(mask, start):
+    """ Return the highest set bit <= start, or None. """
+
+    if start < 0:
+        return None
+
+    m = mask & ((2 << start) - 1)
+    if not m:
+        return None
+
+    return m.bit_length() - 1
+
+
+def _parse_value(s, lo, names):
+    s = s.lower()
+    if s in names:
+        return lo + names.index(s)
+
+    if not s.isdigit():
+        raise ValueError("Bad value: %s" % s)
+
+    return int(s)
+
+
+def _parse_field(s, lo, hi, names):
+    """ Parse one cron field into a bitmask of allowed values. """
+
+    mask = 0
+    for part in s.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            if not step.isdigit() or int(step) == 0:
+                raise ValueError("Bad step: %s" % step)
+            step = int(step)
+
+        if part == "*":
+            start, end = lo, hi
+        elif "-" in part:
+            start, end = part.split("-", 1)
+            start = _parse_value(start, lo, names)
+            end = _parse_value(end, lo, names)
+        else:
+            start = end = _parse_value(part, lo, names)
+            if step > 1:
+                # "5/15" means "5-max/15"
+                end = hi
+
+        if not lo <= start <= end <= hi:
+            raise ValueError("Value out of range: %s" % part)
+
+        for value in range(start, end + 1, step):
+            mask |= 1 << value
+
+    return mask
+
+
+class CronSchedule(object):
+    """ A parsed cron expression.
+
+    Every field is kept as an integer bitmask, so finding the next or
+    the previous matching value of a field is a couple of bit operations.
+    Stepping from one fire time to the next touches each field at most
+    a few times, regardless of how far apart the fire times are.
+    """
+
+    __slots__ = ("minutes", "hours", "doms", "months", "dows_by_offset", "intersect", "tz")
+
+    def __init__(self, expression, tz="UTC"):
+        expression = ALIASES.get(expression.strip().lower(), expression)
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError("Expected 5 fields: %s" % expression)
+
+        masks = [_parse_field(s, *field) for s, field in zip(parts, FIELDS)]
+        self.minutes, self.hours, self.doms, self.months, dows = masks
+
+        # Sunday can be spelled as 0 or 7
+        if dows & (1 << 7):
+            dows = (dows | 1) & 0x7F
+
+        # Standard cron semantics: if either day field starts with "*",
+        # a day has to match both of them, so "0 0 */2 * mon" fires on
+        # Mondays that fall on odd days. Otherwise, either one will do.
+        self.intersect = parts[2].startswith("*") or parts[4].startswith("*")
+
+        # Day-of-month masks for the dow field, one per weekday of the
+        # 1st of the month (0 = Sunday)
+        self.dows_by_offset = []
+        for offset in range(7):
+            mask = 0
+            for day in range(1, 32):
+                if dows & (1 << ((offset + day - 1) % 7)):
+                    mask |= 1 << day
+            self.dows_by_offset.append(mask)
+
+        if self.intersect and not self._dom_possible():
+            raise ValueError("Expression never fires: %s" % expression)
+
+        self.tz = pytz.timezone(tz)
+
+    def _dom_possible(self):
+        for month in range(1, 13):
+            if self.months & (1 << month):
+                days = monthrange(2000, month)[1]
+                if self.doms & ((2 << days) - 1):
+                    return True
+
+        return False
+
+    def _days(self, year, month):
+        """ Return the bitmask of matching days in the given month. """
+
+        ndays = monthrange(year, month)[1]
+        offset = (date(year, month, 1).weekday() + 1) % 7
+        if self.intersect:
+            days = self.doms & self.dows_by_offset[offset]
+        else:
+            days = self.doms | self.dows_by_offset[offset]
+        return days & (((1 << ndays) - 1) << 1)
+
+    def _next_local(self, t):
+        """ Return the first naive local time >= t that matches. """
+
+        year, month, day, hour, minute = t.year, t.month, t.day, t.hour, t.minute
+        for i in range(MAX_STEPS):
+            m = _next_bit(self.months, month)
+            if m is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+            if m != month:
+                month, day, hour, minute = m, 1, 0, 0
+
+            d = _next_bit(self._days(year, month), day)
+            if d is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                continue
+            if d != day:
+                day, hour, minute = d, 0, 0
+
+            h = _next_bit(self.hours, hour)
+            if h is None:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if h != hour:
+                hour, minute = h, 0
+
+            mi = _next_bit(self.minutes, minute)
+            if mi is None:
+                hour, minute = hour + 1, 0
+                continue
+
+            return datetime(year, month, day, hour, mi)
+
+    def _prev_local(self, t):
+        """ Return the last naive local time <= t that matches. """
+
+        year, month, day, hour, minute = t.year, t.month, t.day, t.hour, t.minute
+        for i in range(MAX_STEPS):
+            m = _prev_bit(self.months, month)
+            if m is None:
+                year, month, day, hour, minute = year - 1, 12, 31, 23, 59
+                continue
+            if m != month:
+                month, day, hour, minute = m, 31, 23, 59
+
+            d = _prev_bit(self._days(year, month), day)
+            if d is None:
+                month, day, hour, minute = month - 1, 31, 23, 59
+                continue
+            if d != day:
+                day, hour, minute = d, 23, 59
+
+            h = _prev_bit(self.hours, hour)
+            if h is None:
+                day, hour, minute = day - 1, 23, 59
+                continue
+            if h != hour:
+                hour, minute = h, 59
+
+            mi = _prev_bit(self.minutes, minute)
+            if mi is None:
+                hour, minute = hour - 1, 59
+                continue
+
+            return datetime(year, month, day, hour, mi)
+
+    def _offsets(self, local):
+        """ Return the UTC offsets under which local is a real wall time.
+
+        Uses pytz's transition table directly: a bisect per candidate
+        offset instead of pytz's localize(), which otherwise dominates
+        the cost of evaluating a schedule.
+        """
+
+        transitions = getattr(self.tz, "_utc_transition_times", None)
+        if transitions is None:
+            # UTC or a fixed-offset zone
+            return [self.tz.utcoffset(local)]
+
+        info = self.tz._transition_info
+        i = bisect_right(transitions, local)
+        # UTC offsets are less than a day, so away from transitions only
+        # the current offset applies
+        if transitions[i - 1] + ONE_DAY < local:
+            if i == len(transitions) or local + ONE_DAY < transitions[i]:
+                return [info[i - 1][0]]
+
+        result = []
+        for j in range(max(i - 2, 0), min(i + 1, len(info))):
+            offset = info[j][0]
+            # Is `offset` in effect at the moment local - offset?
+            k = max(bisect_right(transitions, local - offset) - 1, 0)
+            if info[k][0] == offset and offset not in result:
+                result.append(offset)
+
+        # The larger offset is the earlier moment
+        return sorted(result, reverse=True)
+
+    def _localize(self, local):
+        """ Return the UTC datetimes for a naive local time, in order.
+
+        Like cron itself, local times skipped by a DST transition fire
+        as soon as the clock has jumped past them. Local times repeated
+        by a DST transition fire twice.
+        """
+
+        offsets = self._offsets(local)
+        if not offsets:
+            return self._localize(local + ONE_MINUTE)
+
+        return [(local - offset).replace(tzinfo=pytz.utc) for offset in offsets]
+
+    def _repeated(self, local):
+        """ Return the length of the DST overlap around local, if any. """
+
+        offsets = self._offsets(local)
+        if len(offsets) > 1:
+            return offsets[0] - offsets[-1]
+
+        return ZERO
+
+    def next(self, after):
+        """ Return the first fire time strictly after the aware datetime. """
+
+        local = after.astimezone(self.tz).replace(tzinfo=None, second=0, microsecond=0)
+        # Inside a repeated hour, wall times behind `local` can still lie
+        # ahead in real time, so start the walk earlier and keep the best
+        shift = self._repeated(local)
+        start, result = local - shift, None
+        for i in range(MAX_STEPS):
+            start = self._next_local(start)
+            if start is None:
+                return result
+
+            for dt in self._localize(start):
+                if dt > after:
+                    if result is None or dt < result:
+                        result = dt
+                    break
+
+            if result and (not shift or start > local and not self._repeated(start)):
+                return result
+
+            start += ONE_MINUTE
+
+    def prev(self, before):
+        """ Return the last fire time strictly before the aware datetime. """
+
+        local = before.astimezone(self.tz).replace(tzinfo=None, second=0, microsecond=0)
+        # Inside a repeated hour, wall times ahead of `local` can still
+        # lie behind in real time, so start the walk later and keep the best
+        shift = self._repeated(local)
+        start, result = local + shift, None
+        for i in range(MAX_STEPS):
+            start = self._prev_local(start)
+            if start is None:
+                return result
+
+            for dt in reversed(self._localize(start)):
+                if dt < before:
+                    if result is None or dt > result:
+                        result = dt
+                    break
+
+            if result and (not shift or start < local and not self._repeated(start)):
+                return result
+
+            start -= ONE_MINUTE
+
+
+@lru_cache(maxsize=4096)
+def get_schedule(expression, tz="UTC"):
+    """ Parse a cron expression once and cache the result. """
+
+    return CronSchedule(expression, tz)
+
+
+def validate(expression):
+    """ Raise ValueError if the expression cannot be parsed. """
+
+    get_schedule(expression)
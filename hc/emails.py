@@ -1,37 +1,246 @@
-from threading import Thread
+import atexit
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+from uuid import uuid4
 
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template.loader import render_to_string
+from django.utils.html import escape
+from hc.metrics import metrics
 
+logger = logging.getLogger(__name__)
 
-class EmailBase(Thread):
-    def __init__(self, subject, text, html, to, headers):
-        Thread.__init__(self)
-        self.subject = subject
-        self.text = text
-        self.html = html
-        self.to = to
-        self.headers = headers
+# Tells a worker thread to exit
+STOP = object()
 
-    def run(self):
-        msg = EmailMultiAlternatives(
-            self.subject, self.text, to=(self.to,), headers=self.headers
-        )
+# Stands in for the recipient's unsubscribe link in cached renders
+UNSUB_PLACEHOLDER = "UNSUB-LINK-%s" % uuid4().hex
 
-        msg.attach_alternative(self.html, "text/html")
-        msg.send()
+
+class EmailPool(object):
+    """ A fixed set of threads sending queued messages.
+
+    Each thread keeps its own SMTP connection open while there is work
+    and sends whatever has queued up over it. The queue is bounded: once
+    it is full, submit() blocks the caller until the workers catch up.
+    submit() returns a Future, which tells the caller whether the
+    message went out.
+    """
+
+    def __init__(self, workers, maxsize, batch_size, idle_timeout=10):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.queue = Queue(maxsize)
+        self.threads = []
+        self.lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.batches = 0
+        self.send_time = 0.0
+        self.max_send_time = 0.0
+
+    def submit(self, msg):
+        future = Future()
+        self._start()
+        self.queue.put((msg, future))
+        return future
+
+    def close(self, timeout=None):
+        """ Send everything still queued, then stop the worker threads. """
+
+        with self.lock:
+            threads, self.threads = self.threads, []
+
+        for t in threads:
+            self.queue.put(STOP)
+        for t in threads:
+            t.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "sent": self.sent,
+                "failed": self.failed,
+                "batches": self.batches,
+                "avg_send_time": self.send_time / self.batches if self.batches else 0.0,
+                "max_send_time": self.max_send_time,
+            }
+
+    def _start(self):
+        if len(self.threads) >= self.workers:
+            return
+
+        with self.lock:
+            while len(self.threads) < self.workers:
+                t = Thread(target=self._run, daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def _next_batch(self):
+        """ Wait for a message, then take whatever else is queued. """
+
+        batch = [self.queue.get(timeout=self.idle_timeout)]
+        while batch[-1] is not STOP and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        connection = None
+        while True:
+            try:
+                batch = self._next_batch()
+            except Empty:
+                # Don't hold an idle SMTP connection open
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                continue
+
+            stop = batch[-1] is STOP
+            if stop:
+                batch.pop()
+
+            if batch:
+                connection = self._send(connection, batch)
+
+            if stop:
+                if connection is not None:
+                    connection.close()
+                return
+
+    def _send(self, connection, batch):
+        started = time.monotonic()
+        sent = 0
+        for msg, future in batch:
+            try:
+                with metrics.timer("hc_email_send_seconds"):
+                    if connection is None:
+                        connection = get_connection()
+                        connection.open()
+
+                    connection.send_messages([msg])
+            except Exception as e:
+                logger.exception("Failed to send email to %s", ", ".join(msg.to))
+                metrics.inc("hc_emails_sent_total", outcome="error")
+                # Start over with a fresh connection for the next one
+                if connection is not None:
+                    connection.close()
+                connection = None
+                future.set_exception(e)
+            else:
+                metrics.inc("hc_emails_sent_total", outcome="ok")
+                future.set_result(None)
+                sent += 1
+
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.sent += sent
+            self.failed += len(batch) - sent
+            self.batches += 1
+            self.send_time += elapsed
+            self.max_send_time = max(self.max_send_time, elapsed)
+
+        return connection
+
+
+class RenderCache(object):
+    """ A small in-process LRU cache whose entries expire after `ttl`.
+
+    When a check changes status, every email channel of its project gets
+    an almost identical message. Keying rendered emails by the event lets
+    all those deliveries share one render.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = Lock()
+        self.items = OrderedDict()
+
+    def get_or_set(self, key, fn):
+        now = time.monotonic()
+        with self.lock:
+            item = self.items.get(key)
+            if item and item[0] > now:
+                self.items.move_to_end(key)
+                return item[1]
+
+        # Render outside the lock; a concurrent miss renders twice
+        value = fn()
+        with self.lock:
+            self.items[key] = (now + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+render_cache = RenderCache(maxsize=256, ttl=settings.EMAIL_RENDER_CACHE_TTL)
+
+pool = EmailPool(
+    settings.EMAIL_POOL_WORKERS, settings.EMAIL_QUEUE_SIZE, settings.EMAIL_BATCH_SIZE
+)
+atexit.register(pool.close, timeout=30)
+metrics.gauge("hc_email_queue_depth", pool.queue.qsize)
 
 
 class Email(object):
     @staticmethod
-    def _send(name, to, context, headers=None):
-        subject = render_to_string("notifications/%s-subject.html" % name, context).strip()
-        text = render_to_string("notifications/%s-body-text.html" % name, context)
-        html = render_to_string("notifications/%s-body-html.html" % name, context)
+    def _render(name, context):
+        with metrics.timer("hc_email_render_seconds", template=name):
+            subject = render_to_string("notifications/%s-subject.html" % name, context).strip()
+            text = render_to_string("notifications/%s-body-text.html" % name, context)
+            html = render_to_string("notifications/%s-body-html.html" % name, context)
+
+        return subject, text, html
+
+    @staticmethod
+    def _send(name, to, context, headers=None, cache_key=None):
+        """ Render and queue an email, and return the pool's Future for it.
+
+        If cache_key is given, messages with the same name and cache_key
+        share one render, and only the unsubscribe link is filled in per
+        recipient.
+        """
+
+        if cache_key is None:
+            subject, text, html = Email._render(name, context)
+            metrics.inc("hc_emails_total", cache="off")
+        else:
+            unsub_link = context.get("unsub_link", "")
+            shared = dict(context, unsub_link=UNSUB_PLACEHOLDER)
+            rendered = []
+
+            def render():
+                rendered.append(True)
+                return Email._render(name, shared)
+
+            subject, text, html = render_cache.get_or_set((name,) + cache_key, render)
+            metrics.inc("hc_emails_total", cache="miss" if rendered else "hit")
+
+            subject = subject.replace(UNSUB_PLACEHOLDER, unsub_link)
+            text = text.replace(UNSUB_PLACEHOLDER, unsub_link)
+            html = html.replace(UNSUB_PLACEHOLDER, escape(unsub_link))
 
-        t = EmailBase(subject, text, html, to, headers)
-        t.start()
+        msg = EmailMultiAlternatives(subject, text, to=(to,), headers=headers)
+        msg.attach_alternative(html, "text/html")
+        return pool.submit(msg)
 
-    def alert(self, to, context, headers=None):
-        self._send("alert", to, context, headers)
+    def alert(self, to, context, headers=None, cache_key=None):
+        return self._send("alert", to, context, headers, cache_key)
@@ -0,0 +1,136 @@
+import csv
+import json
+import zlib
+from datetime import datetime
+from uuid import UUID
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from hc.models import Notification, Ping
+
+# (column, field) pairs; each row is read with values_list(*fields)
+COLUMNS = {
+    "pings": (
+        ("id", "id"),
+        ("check", "owner__code"),
+        ("n", "count"),
+        ("created_at", "created_at"),
+        ("kind", "kind"),
+        ("scheme", "scheme"),
+        ("remote_addr", "remote_addr"),
+        ("method", "method"),
+        ("ua", "ua"),
+        ("body", "body"),
+        ("body_raw", "body_raw"),
+    ),
+    "notifications": (
+        ("id", "id"),
+        ("check", "owner__code"),
+        ("created_at", "created_at"),
+        ("check_status", "check_status"),
+        ("channel", "channel__code"),
+        ("channel_kind", "channel__kind"),
+        ("error", "error"),
+    ),
+}
+
+MODELS = {"pings": Ping, "notifications": Notification}
+FORMATS = ("csv", "jsonl")
+
+
+def parse_time(value):
+    """ Parse an ISO 8601 timestamp or date, treating naive ones as UTC.
+
+    A date stands for its midnight.
+    """
+
+    dt = parse_datetime(value)
+    if dt is None:
+        d = parse_date(value)
+        if d is None:
+            raise ValueError("Bad timestamp: %s" % value)
+        dt = datetime(d.year, d.month, d.day)
+
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.utc)
+
+    return dt
+
+
+def get_queryset(kind, check=None, project=None, since=None, until=None):
+    """ Return the rows to export, oldest first.
+
+    `check` and `project` are codes, `since` and `until` ISO 8601
+    timestamps or dates; all of them are optional. Raises ValueError
+    on bad input.
+    """
+
+    if kind not in MODELS:
+        raise ValueError("Unknown kind: %s" % kind)
+
+    q = MODELS[kind].objects.all()
+    if check:
+        q = q.filter(owner__code=UUID(check))
+    if project:
+        q = q.filter(owner__project__code=UUID(project))
+    if since:
+        q = q.filter(created_at__gte=parse_time(since))
+    if until:
+        q = q.filter(created_at__lt=parse_time(until))
+
+    return q.order_by("id")
+
+
+def iter_rows(kind, q, chunk_size=2000):
+    """ Yield export rows as dicts, holding one chunk in memory at a time.
+
+    QuerySet.iterator() uses a server-side cursor where the database
+    supports one, so neither the rows nor model instances pile up.
+    """
+
+    columns = [column for column, field in COLUMNS[kind]]
+    fields = [field for column, field in COLUMNS[kind]]
+    for values in q.values_list(*fields).iterator(chunk_size=chunk_size):
+        row = dict(zip(columns, values))
+        if "body_raw" in row:
+            # Ping.get_body(), without instantiating the ping
+            raw = row.pop("body_raw")
+            if raw is not None:
+                row["body"] = zlib.decompress(raw).decode()
+
+        row["created_at"] = row["created_at"].isoformat()
+        for key in ("check", "channel"):
+            if row.get(key) is not None:
+                row[key] = str(row[key])
+
+        yield row
+
+
+class Echo(object):
+    """ A file-like object that hands back whatever is written to it. """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(kind, rows):
+    columns = [column for column, field in COLUMNS[kind] if column != "body_raw"]
+    writer = csv.DictWriter(Echo(), columns)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+def lines(kind, q, fmt, chunk_size=2000):
+    """ Yield the export of q, line by line, in the given format. """
+
+    rows = iter_rows(kind, q, chunk_size)
+    if fmt == "csv":
+        return csv_lines(kind, rows)
+
+    return jsonl_lines(rows)
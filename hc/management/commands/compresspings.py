@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models.functions import Length
+from hc.models import Ping
+
+
+class Command(BaseCommand):
+    help = "Compresses the bodies of existing pings above the size threshold."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        # A UTF-8 character takes at most 4 bytes, so shorter bodies
+        # cannot be over the threshold
+        min_length = settings.PING_BODY_COMPRESS_THRESHOLD // 4
+        q = Ping.objects.annotate(body_length=Length("body"))
+        q = q.filter(body_length__gt=min_length).only("id", "body").order_by("id")
+
+        total, last_id = 0, 0
+        while True:
+            chunk = list(q.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+
+            changed = [ping for ping in chunk if ping.set_body(ping.body)]
+            Ping.objects.bulk_update(changed, ["body", "body_raw"])
+            total += len(changed)
+            last_id = chunk[-1].id
+            self.stdout.write("Processed up to id=%d, compressed %d" % (last_id, total))
+
+        return "Done! Compressed %d ping(s)" % total
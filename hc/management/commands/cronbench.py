@@ -0,0 +1,52 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from hc import cron
+
+EXPRESSIONS = (
+    "* * * * *",
+    "*/5 * * * *",
+    "0 * * * *",
+    "30 2 * * *",
+    "0 9 * * mon-fri",
+    "15 10 1,15 * *",
+    "0 0 1 */3 *",
+    "@daily",
+)
+
+TIMEZONES = ("UTC", "Europe/Riga", "America/New_York", "Asia/Kolkata")
+
+
+class Command(BaseCommand):
+    help = "Times next-deadline evaluation for a large number of cron checks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--checks", type=int, default=1000000)
+
+    def handle(self, *args, **options):
+        # Synthetic checks: (schedule, timezone, last ping)
+        rng = random.Random(0)
+        now = timezone.now()
+        checks = [
+            (
+                rng.choice(EXPRESSIONS),
+                rng.choice(TIMEZONES),
+                now - timedelta(seconds=rng.randint(0, 86400 * 30)),
+            )
+            for i in range(options["checks"])
+        ]
+
+        cron.get_schedule.cache_clear()
+        started = time.perf_counter()
+        for schedule, tz, last_ping in checks:
+            cron.get_schedule(schedule, tz).next(last_ping)
+        elapsed = time.perf_counter() - started
+
+        info = cron.get_schedule.cache_info()
+        self.stdout.write("Checks:      %d" % len(checks))
+        self.stdout.write("Elapsed:     %.2fs" % elapsed)
+        self.stdout.write("Per check:   %.2fus" % (elapsed / len(checks) * 1e6))
+        self.stdout.write("Cache:       %d hits, %d misses" % (info.hits, info.misses))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from hc import export as exporter
+
+
+class Command(BaseCommand):
+    help = "Writes pings or notifications as CSV or JSON Lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(exporter.MODELS))
+        parser.add_argument("--format", choices=exporter.FORMATS, default="csv")
+        parser.add_argument("--check", help="Only export this check (code)")
+        parser.add_argument("--project", help="Only export this project (code)")
+        parser.add_argument("--since", help="ISO 8601 date or timestamp, inclusive")
+        parser.add_argument("--until", help="ISO 8601 date or timestamp, exclusive")
+        parser.add_argument("--output", help="File to write to, stdout by default")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        kind = options["kind"]
+        try:
+            q = exporter.get_queryset(
+                kind,
+                check=options["check"],
+                project=options["project"],
+                since=options["since"],
+                until=options["until"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        lines = exporter.lines(kind, q, options["format"], options["chunk_size"])
+        if options["output"]:
+            with open(options["output"], "w", newline="") as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from hc.models import Check
+
+
+class Command(BaseCommand):
+    help = "Recomputes Check.alert_after for existing checks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        fields = ("id", "kind", "timeout", "grace", "schedule", "status")
+        fields += ("last_ping", "last_start", "alert_after")
+        fields += ("project", "project__owner", "project__owner__timezone")
+
+        q = Check.objects.filter(Q(last_ping__isnull=False) | Q(last_start__isnull=False))
+        q = q.select_related("project__owner").only(*fields).order_by("id")
+
+        total, last_id = 0, 0
+        while True:
+            chunk = list(q.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+
+            changed = []
+            for check in chunk:
+                alert_after = check.going_down_after()
+                if alert_after != check.alert_after:
+                    check.alert_after = alert_after
+                    changed.append(check)
+
+            Check.objects.bulk_update(changed, ["alert_after"])
+            total += len(changed)
+            last_id = chunk[-1].id
+            self.stdout.write("Processed up to id=%d, updated %d" % (last_id, total))
+
+        return "Done! Updated %d check(s)" % total
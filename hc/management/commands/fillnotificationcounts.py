@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from hc.models import Channel, Notification
+
+
+class Command(BaseCommand):
+    help = "Recomputes Channel.notification_count from stored notifications."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        q = Channel.objects.order_by("id").only("id", "notification_count")
+
+        total, last_id = 0, 0
+        while True:
+            chunk = list(q.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+
+            ids = [channel.id for channel in chunk]
+            counts = Notification.objects.filter(channel_id__in=ids)
+            counts = dict(counts.values_list("channel_id").annotate(n=Count("id")))
+
+            changed = []
+            for channel in chunk:
+                n = counts.get(channel.id, 0)
+                if n != channel.notification_count:
+                    channel.notification_count = n
+                    changed.append(channel)
+
+            Channel.objects.bulk_update(changed, ["notification_count"])
+            total += len(changed)
+            last_id = chunk[-1].id
+            self.stdout.write("Processed up to id=%d, updated %d" % (last_id, total))
+
+        return "Done! Updated %d channel(s)" % total
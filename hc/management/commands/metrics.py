@@ -0,0 +1,21 @@
+import argparse
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from hc.metrics import metrics
+
+
+class Command(BaseCommand):
+    help = "Runs a management command with metrics enabled, then prints them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("command", help="The management command to run")
+        parser.add_argument("args", nargs=argparse.REMAINDER)
+
+    def handle(self, *args, **options):
+        metrics.enabled = True
+        metrics.clear()
+        try:
+            call_command(options["command"], *args)
+        finally:
+            self.stdout.write(metrics.render(), ending="")
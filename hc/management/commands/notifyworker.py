@@ -0,0 +1,171 @@
+import logging
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from hc.metrics import metrics, serve
+from hc.models import Notification
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Delivers queued notifications."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--no-loop",
+            action="store_false",
+            dest="loop",
+            default=True,
+            help="Exit once the queue is empty",
+        )
+        parser.add_argument("--workers", type=int, default=settings.NOTIFY_WORKERS)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Serve this process's metrics over HTTP on this port",
+        )
+        parser.add_argument(
+            "--metrics-addr",
+            default="127.0.0.1",
+            help="Address to serve metrics on (default: 127.0.0.1)",
+        )
+
+    def lease(self, limit, slots=None):
+        """ Lease up to `limit` queued notifications to this worker.
+
+        Rows are picked with SELECT ... FOR UPDATE SKIP LOCKED and then
+        marked as leased, so concurrent workers never pick the same row.
+        If a worker dies, its lease runs out and another worker retries
+        the notification, up to NOTIFY_MAX_ATTEMPTS times.
+
+        `slots` maps channel kinds to how many more of their rows may be
+        leased; kinds not in it are not limited. Rows only get leased
+        once they can start, so a backlog of one slow kind neither ties
+        up the worker threads nor sits leased until its lease runs out.
+        """
+
+        slots = dict(slots or {})
+        now = timezone.now()
+        with transaction.atomic():
+            q = Notification.objects.select_for_update(skip_locked=True, of=("self",))
+            q = q.filter(Q(lease_until=None) | Q(lease_until__lt=now), pending=True)
+            full = [kind for kind, n in slots.items() if n <= 0]
+            if full:
+                q = q.exclude(channel__kind__in=full)
+
+            batch = []
+            for notification in q.for_delivery().order_by("id")[:limit]:
+                kind = notification.channel.kind
+                if kind in slots:
+                    if slots[kind] <= 0:
+                        # Stays queued, it is still locked until commit
+                        continue
+                    slots[kind] -= 1
+                batch.append(notification)
+
+            Notification.prefetch_sorts(batch)
+
+            ids = [n.id for n in batch]
+            lease_until = now + timedelta(seconds=settings.NOTIFY_LEASE_SECONDS)
+            q = Notification.objects.filter(id__in=ids)
+            q.update(lease_until=lease_until, attempts=F("attempts") + 1)
+            for notification in batch:
+                notification.lease_until = lease_until
+
+        return batch
+
+    def renew(self, notification):
+        """ Restart the lease of a notification about to be delivered.
+
+        Returns False if the lease has run out and another worker has
+        taken the notification over in the meantime.
+        """
+
+        lease_until = timezone.now() + timedelta(seconds=settings.NOTIFY_LEASE_SECONDS)
+        q = Notification.objects.filter(
+            id=notification.id, pending=True, lease_until=notification.lease_until
+        )
+        if not q.update(lease_until=lease_until):
+            return False
+
+        notification.lease_until = lease_until
+        return True
+
+    def deliver(self, notification):
+        close_old_connections()
+
+        if notification.attempts >= settings.NOTIFY_MAX_ATTEMPTS:
+            error = "Gave up after %d attempts" % notification.attempts
+            if notification.error:
+                # Keep the reason the last attempt failed
+                error += ": " + notification.error
+            notification.error = error[:200]
+            notification.pending = False
+            notification.save(update_fields=["error", "pending"])
+            return
+
+        if not self.renew(notification):
+            return
+
+        kind = notification.channel.kind
+        try:
+            with metrics.timer("hc_notify_seconds", kind=kind):
+                notification.deliver()
+        except Exception:
+            # Leave it leased; it is retried once the lease runs out
+            logger.exception("Failed to deliver notification %d", notification.id)
+
+    def free_slots(self, inflight):
+        """ Return how many more rows of each limited kind can be leased. """
+
+        running = Counter(inflight.values())
+        limits = settings.NOTIFY_KIND_CONCURRENCY
+        return {kind: n - running[kind] for kind, n in limits.items()}
+
+    def handle(self, *args, **options):
+        self.stdout.write("notifyworker is now running")
+        if options["metrics_port"] is not None:
+            serve(options["metrics_port"], options["metrics_addr"])
+
+        # Keep enough work leased to keep every thread busy, but not so
+        # much that it sits in memory while other workers are idle
+        capacity = options["workers"] * 2
+
+        sent = 0
+        # Future -> channel kind of the notification it delivers
+        inflight = {}
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            while True:
+                batch = []
+                if len(inflight) < capacity:
+                    batch = self.lease(capacity - len(inflight), self.free_slots(inflight))
+
+                for notification in batch:
+                    future = pool.submit(self.deliver, notification)
+                    inflight[future] = notification.channel.kind
+                sent += len(batch)
+
+                if inflight:
+                    done, _ = wait(inflight, options["interval"], FIRST_COMPLETED)
+                    for future in done:
+                        del inflight[future]
+                elif options["loop"]:
+                    time.sleep(options["interval"])
+                else:
+                    break
+
+        return "Processed %d notification(s)" % sent
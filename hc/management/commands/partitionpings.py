@@ -0,0 +1,65 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from hc import partitions
+from hc.models import Ping
+
+
+class Command(BaseCommand):
+    help = "Creates upcoming ping partitions and drops expired ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="Convert the plain ping table into a partitioned one first",
+        )
+        parser.add_argument("--ahead", type=int, default=settings.PING_PARTITIONS_AHEAD)
+        parser.add_argument("--retention-days", type=int, default=settings.PING_RETENTION_DAYS)
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be dropped or deleted",
+        )
+
+    def handle(self, *args, **options):
+        period = settings.PING_PARTITION_PERIOD
+        if period not in ("day", "month"):
+            raise CommandError("PING_PARTITION_PERIOD must be 'day' or 'month'")
+
+        now = timezone.now()
+        before = None
+        if options["retention_days"]:
+            before = now - timedelta(days=options["retention_days"])
+
+        if not partitions.supported():
+            if before is None:
+                return "Partitioning is not supported here, nothing to do"
+
+            q = Ping.objects.filter(created_at__lt=before)
+            if options["dry_run"]:
+                return "Would delete %d pings" % q.count()
+
+            deleted = partitions.delete_before(before, options["chunk_size"])
+            return "Deleted %d pings" % deleted
+
+        if not partitions.is_partitioned():
+            if not options["convert"]:
+                raise CommandError("The ping table is not partitioned, use --convert")
+
+            partitions.convert(period, now)
+            self.stdout.write("Converted %s" % partitions.TABLE)
+
+        for name in partitions.create_partitions(period, options["ahead"], now):
+            self.stdout.write("Created %s" % name)
+
+        if before is not None:
+            dropped = partitions.drop_partitions(before, options["dry_run"])
+            verb = "Would drop" if options["dry_run"] else "Dropped"
+            for name in dropped:
+                self.stdout.write("%s %s" % (verb, name))
+
+        return "Done!"
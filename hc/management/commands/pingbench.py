@@ -0,0 +1,85 @@
+import time
+from threading import Thread
+
+from django.db import connection
+from django.test import Client, override_settings
+from hc.bench import BenchCommand, scratch_project
+from hc.buffers import pings
+from hc.models import Check
+
+
+def percentile(values, p):
+    """ Return the p-th percentile of an already sorted list. """
+
+    if not values:
+        return 0.0
+
+    index = min(len(values) - 1, int(len(values) * p / 100))
+    return values[index]
+
+
+class Command(BenchCommand):
+    help = "Load-test the ping endpoint and report throughput and latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--checks", type=int, default=100)
+        parser.add_argument("--pings", type=int, default=10000)
+        parser.add_argument("--threads", type=int, default=4)
+
+    def setup(self, project, num_checks):
+        checks = [Check(project=project, name="bench") for i in range(num_checks)]
+        Check.objects.bulk_create(checks)
+        return list(project.check_set.values_list("code", flat=True))
+
+    def worker(self, codes, num_pings, latencies, errors):
+        client = Client()
+        actions = ("", "/start", "", "/fail")
+        try:
+            for i in range(num_pings):
+                url = "/ping/%s%s" % (codes[i % len(codes)], actions[i % 4])
+                t = time.perf_counter()
+                r = client.get(url)
+                latencies.append(time.perf_counter() - t)
+                if r.status_code != 200:
+                    errors.append(r.status_code)
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        # The test client sends requests for the "testserver" host
+        with override_settings(ALLOWED_HOSTS=["testserver"]):
+            with scratch_project("pingbench") as project:
+                try:
+                    self.run(project, options)
+                finally:
+                    # Write out buffered pings before their checks go away
+                    pings.flush()
+
+    def run(self, project, options):
+        codes = self.setup(project, options["checks"])
+        per_thread = options["pings"] // options["threads"]
+
+        latencies, errors = [], []
+        threads = []
+        for i in range(options["threads"]):
+            shard = codes[i :: options["threads"]] or codes
+            t = Thread(target=self.worker, args=(shard, per_thread, latencies, errors))
+            threads.append(t)
+
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        pings.flush()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        self.stdout.write("Backend:   %s" % connection.vendor)
+        self.stdout.write("Pings:     %d" % len(latencies))
+        self.stdout.write("Errors:    %d" % len(errors))
+        self.stdout.write("Elapsed:   %.2fs" % elapsed)
+        self.stdout.write("Pings/sec: %.0f" % (len(latencies) / elapsed))
+        for p in (50, 95, 99):
+            ms = percentile(latencies, p) * 1000
+            self.stdout.write("p%d:       %.2fms" % (p, ms))
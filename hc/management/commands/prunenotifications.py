@@ -0,0 +1,7 @@
+from hc.models import Notification
+from hc.pruning import PruneCommand
+
+
+class Command(PruneCommand):
+    help = "Deletes all but the newest notifications of every check."
+    model = Notification
@@ -0,0 +1,13 @@
+from django.conf import settings
+from hc.models import Ping
+from hc.pruning import PruneCommand
+
+
+class Command(PruneCommand):
+    help = "Deletes all but the newest pings of every check."
+    model = Ping
+
+    def get_checks(self):
+        # A check cannot have more stored pings than it has ever received
+        min_limit = min(settings.PING_LOG_LIMIT, settings.PING_LOG_LIMIT_PAID)
+        return super().get_checks().filter(ping_count__gt=min_limit)
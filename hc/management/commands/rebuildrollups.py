@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from hc import rollups
+from hc.models import Check, Ping, Rollup
+
+
+class Command(BaseCommand):
+    help = "Recomputes the ping totals of the rollups from stored pings."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def pings(self, check_id, chunk_size):
+        """ Yield a check's pings in order, with `duration` filled in. """
+
+        q = Ping.objects.filter(owner_id=check_id).order_by("id")
+        q = q.only("id", "owner_id", "kind", "created_at")
+
+        last_start = None
+        for ping in q.iterator(chunk_size=chunk_size):
+            ping.duration = None
+            if ping.kind == "start":
+                last_start = ping.created_at
+            else:
+                if last_start:
+                    ping.duration = ping.created_at - last_start
+                last_start = None
+
+            yield ping
+
+    def rebuild(self, check_id, chunk_size):
+        """ Recompute the rollups of one check that stored pings cover.
+
+        Once prunepings has removed a check's older pings, the rollups
+        are all that is left of them. Periods that start before the
+        oldest stored ping are then left as they are.
+        """
+
+        q = Ping.objects.filter(owner_id=check_id).order_by("id")
+        oldest = q.values_list("count", "created_at").first()
+        if oldest is None:
+            # Never pinged, or all of its pings are gone
+            return 0
+
+        count, created_at = oldest
+        cutoff = created_at if count > 1 else None
+
+        totals = rollups.aggregate_pings(self.pings(check_id, chunk_size))
+        if cutoff:
+            totals = {key: t for key, t in totals.items() if key[2] >= cutoff}
+
+        with transaction.atomic():
+            existing = Rollup.objects.select_for_update().filter(owner_id=check_id)
+            if cutoff:
+                existing = existing.filter(start__gte=cutoff)
+            rows = {(r.owner_id, r.period, r.start): r for r in existing}
+
+            changed, created = [], []
+            for key in set(rows) | set(totals):
+                t = totals.get(key) or rollups.Totals()
+                row = rows.get(key)
+                if row is None:
+                    row = Rollup(owner_id=key[0], period=key[1], start=key[2])
+                    created.append(row)
+                else:
+                    changed.append(row)
+
+                # Downtime is not derived from pings, it is kept as is
+                row.n_pings = t.pings
+                row.n_fails = t.fails
+                row.n_durations = len(t.durations)
+                row.total_duration = sum(t.durations)
+                row.min_duration = min(t.durations, default=None)
+                row.max_duration = max(t.durations, default=None)
+
+            fields = ["n_pings", "n_fails", "n_durations", "total_duration"]
+            fields += ["min_duration", "max_duration"]
+            Rollup.objects.bulk_update(changed, fields)
+            Rollup.objects.bulk_create(created)
+
+        return len(changed) + len(created)
+
+    def handle(self, *args, **options):
+        ids = Check.objects.order_by("id").values_list("id", flat=True)
+
+        total = 0
+        for i, check_id in enumerate(ids.iterator(), start=1):
+            total += self.rebuild(check_id, options["chunk_size"])
+            if i % 1000 == 0:
+                self.stdout.write("Visited %d checks, %d rollups so far" % (i, total))
+
+        return "Done! Rebuilt %d rollup(s)" % total
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+from hc.utils import replace
+
+
+def split_replace(template, ctx):
+    """ The previous implementation: every placeholder tried at every "$".
+
+    Unlike replace(), it lets "$TAG1" shadow "$TAG10".
+    """
+
+    parts = template.split("$")
+    result = [parts.pop(0)]
+    for part in parts:
+        part = "$" + part
+        for placeholder, value in ctx.items():
+            if part.startswith(placeholder):
+                part = part.replace(placeholder, value, 1)
+                break
+        result.append(part)
+
+    return "".join(result)
+
+
+class Command(BaseCommand):
+    help = "Times placeholder substitution in shell commands."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tags", type=int, nargs="+", default=[0, 10, 100])
+        parser.add_argument("--repeat", type=int, default=20000)
+
+    def context(self, ntags):
+        # The same placeholders Shell.prepare() defines
+        ctx = {
+            "$CODE": "5b4a7d3e-0000-4000-8000-000000000000",
+            "$STATUS": "down",
+            "$NOW": "2020-01-01T00:00:00+00:00",
+            "$NAME": "backup",
+            "$TAGS": " ".join("tag%d" % i for i in range(ntags)),
+        }
+        for i in range(ntags):
+            ctx["$TAG%d" % (i + 1)] = "tag%d" % i
+
+        return ctx
+
+    def time(self, fn, template, ctx, repeat):
+        started = time.perf_counter()
+        for i in range(repeat):
+            fn(template, ctx)
+
+        return (time.perf_counter() - started) / repeat * 1e6
+
+    def handle(self, *args, **options):
+        template = "notify --check $CODE --name $NAME --status $STATUS --at $NOW --tags $TAGS"
+        self.stdout.write("%8s %14s %14s" % ("tags", "split us/call", "regex us/call"))
+        for ntags in options["tags"]:
+            ctx = self.context(ntags)
+            # The first and the last tag, if there are any
+            t = template + "".join(" $TAG%d" % i for i in sorted({1, ntags}) if i)
+
+            old = self.time(split_replace, t, ctx, options["repeat"])
+            new = self.time(replace, t, ctx, options["repeat"])
+            self.stdout.write("%8d %14.2f %14.2f" % (ntags, old, new))
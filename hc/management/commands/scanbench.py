@@ -0,0 +1,59 @@
+import time
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+from hc.bench import BenchCommand, scratch_project
+from hc.enums import Status
+from hc.models import Check
+
+
+class Command(BenchCommand):
+    help = "Times the sendalerts scan while the number of checks grows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--steps", type=int, nargs="+", default=[1000, 10000, 100000])
+        parser.add_argument("--due", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def scan(self, batch_size):
+        """ Run the same query as sendalerts, without flipping anything. """
+
+        with transaction.atomic():
+            q = Check.objects.select_for_update(skip_locked=True)
+            q = q.filter(status=Status.up.name, alert_after__lt=timezone.now())
+            return list(q.order_by("alert_after")[:batch_size])
+
+    def handle(self, *args, **options):
+        with scratch_project("scanbench") as project:
+            self.run(project, options)
+
+    def run(self, project, options):
+        # A fixed number of overdue checks; everything else is not due yet
+        now = timezone.now()
+        overdue = now - timedelta(minutes=5)
+        due = [
+            Check(project=project, status="up", alert_after=overdue)
+            for i in range(options["due"])
+        ]
+        Check.objects.bulk_create(due)
+
+        self.stdout.write("Backend: %s" % connection.vendor)
+        self.stdout.write("%12s %12s %12s" % ("checks", "due", "ms/scan"))
+
+        total = options["due"]
+        later = now + timedelta(days=1)
+        for step in options["steps"]:
+            fresh = [
+                Check(project=project, status="up", alert_after=later)
+                for i in range(step - total)
+            ]
+            Check.objects.bulk_create(fresh)
+            total = max(total, step)
+
+            started = time.perf_counter()
+            for i in range(options["repeat"]):
+                found = self.scan(options["batch_size"])
+            elapsed = (time.perf_counter() - started) / options["repeat"]
+            self.stdout.write("%12d %12d %12.3f" % (total, len(found), elapsed * 1000))
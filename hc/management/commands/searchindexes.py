@@ -0,0 +1,35 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from hc.models import Channel, Check
+
+# (index name, model, column) for every column the admin searches by
+# substring
+INDEXES = (
+    ("hc_check_name_trgm", Check, "name"),
+    ("hc_channel_value_trgm", Channel, "value"),
+    ("auth_user_email_trgm", User, "email"),
+)
+
+
+class Command(BaseCommand):
+    help = "Creates the trigram indexes used by the admin search (PostgreSQL only)."
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            return "Trigram indexes need PostgreSQL, nothing to do"
+
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for name, model, column in INDEXES:
+                # Matches the UPPER(...) LIKE UPPER(...) that icontains
+                # compiles to. CONCURRENTLY keeps the table writable
+                # while the index builds.
+                cursor.execute(
+                    "CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s "
+                    "USING gin ((UPPER(%s::text)) gin_trgm_ops)"
+                    % (name, model._meta.db_table, column)
+                )
+                self.stdout.write("Created %s" % name)
+
+        return "Done!"
@@ -0,0 +1,87 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from hc.enums import Status
+from hc.metrics import metrics, serve
+from hc.models import Check
+
+
+class Command(BaseCommand):
+    help = "Flips overdue checks to down and queues the DOWN alerts."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--no-loop",
+            action="store_false",
+            dest="loop",
+            default=True,
+            help="Do not keep running indefinitely in a wait loop",
+        )
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2,
+            help="Seconds to wait when there are no overdue checks",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Serve this process's metrics over HTTP on this port",
+        )
+        parser.add_argument(
+            "--metrics-addr",
+            default="127.0.0.1",
+            help="Address to serve metrics on (default: 127.0.0.1)",
+        )
+
+    def claim(self, batch_size):
+        """ Flip up to batch_size overdue checks to down and return them.
+
+        The rows are read with SELECT ... FOR UPDATE SKIP LOCKED over the
+        (status, alert_after) index, so several sendalerts processes can
+        run side by side: each of them claims a disjoint set of checks,
+        and a check is only ever claimed once per outage. The alerts are
+        queued in the same transaction, so a crash cannot flip a check
+        without also queueing its notifications.
+        """
+
+        now = timezone.now()
+        with metrics.timer("hc_sendalerts_claim_seconds"), transaction.atomic():
+            q = Check.objects.select_for_update(skip_locked=True)
+            q = q.filter(status=Status.up.name, alert_after__lt=now)
+            checks = list(q.order_by("alert_after")[:batch_size])
+
+            ids = [check.id for check in checks]
+            q = Check.objects.filter(id__in=ids)
+            q.update(status=Status.down.name, down_since=F("alert_after"))
+
+            for check in checks:
+                check.status = Status.down.name
+                check.down_since = check.alert_after
+                self.stdout.write("Queueing alerts, code=%s" % check.code)
+                check.send_alert()
+
+        metrics.inc("hc_sendalerts_flips_total", len(checks))
+        return checks
+
+    def handle(self, *args, **options):
+        self.stdout.write("sendalerts is now running")
+        if options["metrics_port"] is not None:
+            serve(options["metrics_port"], options["metrics_addr"])
+
+        sent = 0
+        while True:
+            checks = self.claim(options["batch_size"])
+            sent += len(checks)
+            if not options["loop"]:
+                break
+
+            # A full batch means there is likely more work queued up
+            if len(checks) < options["batch_size"]:
+                time.sleep(options["interval"])
+
+        return "Queued alerts for %d check(s)" % sent
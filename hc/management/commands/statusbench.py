@@ -0,0 +1,74 @@
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+from hc import snapshots
+from hc.bench import BenchCommand, scratch_project
+from hc.models import Check
+
+
+class Command(BenchCommand):
+    help = "Compares status evaluation via Check instances and via snapshots."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--steps", type=int, nargs="+", default=[1000, 10000, 50000])
+
+    def measure(self, fn):
+        """ Return (result, seconds, peak KiB allocated) of fn().
+
+        Runs fn() twice, because tracing allocations slows it down.
+        """
+
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+
+        return result, elapsed, peak
+
+    def with_models(self, q, now):
+        checks = list(q.select_related("project__owner"))
+        return {check.id: check.get_status(now) for check in checks}
+
+    def handle(self, *args, **options):
+        with scratch_project("statusbench", timezone="Europe/Riga") as project:
+            self.run(project, options)
+
+    def run(self, project, options):
+        q = Check.objects.filter(project=project)
+
+        self.stdout.write("Backend: %s" % connection.vendor)
+        self.stdout.write(
+            "%10s %12s %12s %12s %12s" % ("checks", "models ms", "models KiB", "snap ms", "snap KiB")
+        )
+
+        now = timezone.now()
+        total = 0
+        for step in options["steps"]:
+            # A mix of simple and cron checks, up, in grace and down
+            fresh = []
+            for i in range(total, step):
+                check = Check(project=project, status="up")
+                check.last_ping = now - timedelta(minutes=i % 3000)
+                if i % 4 == 0:
+                    check.kind, check.schedule = "cron", "*/%d * * * *" % (i % 30 + 1)
+                fresh.append(check)
+            Check.objects.bulk_create(fresh)
+            total = step
+
+            expected, m_time, m_peak = self.measure(lambda: self.with_models(q, now))
+            found, s_time, s_peak = self.measure(lambda: snapshots.statuses(q, now))
+            assert found == expected
+
+            self.stdout.write(
+                "%10d %12.1f %12.0f %12.1f %12.0f"
+                % (total, m_time * 1000, m_peak, s_time * 1000, s_peak)
+            )
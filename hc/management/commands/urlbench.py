@@ -0,0 +1,41 @@
+import time
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from hc.models import Check
+
+
+class Command(BaseCommand):
+    help = "Compares ping URL rendering with and without the site cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--checks", type=int, default=500)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def uncached(self, checks):
+        # What Check.url() used to do
+        return ["{}/{}".format(Site.objects.first().domain, c.code) for c in checks]
+
+    def cached(self, checks):
+        return [check.url() for check in checks]
+
+    def measure(self, fn, checks, repeat):
+        with CaptureQueriesContext(connection) as ctx:
+            fn(checks)
+
+        started = time.perf_counter()
+        for i in range(repeat):
+            fn(checks)
+        elapsed = (time.perf_counter() - started) / repeat
+        return elapsed, len(ctx.captured_queries)
+
+    def handle(self, *args, **options):
+        # Unsaved instances are enough, url() only reads the code
+        checks = [Check() for i in range(options["checks"])]
+
+        self.stdout.write("Rendering %d check URLs:" % len(checks))
+        for label, fn in (("before", self.uncached), ("after", self.cached)):
+            elapsed, queries = self.measure(fn, checks, options["repeat"])
+            self.stdout.write("%-8s %8.2fms %6d queries" % (label, elapsed * 1000, queries))
@@ -0,0 +1,211 @@
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DESCRIPTIONS = {
+    "hc_ping_seconds": "Time spent handling a ping request",
+    "hc_pings_total": "Pings handled, by path taken",
+    "hc_ping_flush_seconds": "Time spent writing a batch of buffered pings",
+    "hc_sendalerts_claim_seconds": "Time spent claiming and flipping overdue checks",
+    "hc_sendalerts_flips_total": "Checks flipped to down by sendalerts",
+    "hc_email_render_seconds": "Time spent rendering an email",
+    "hc_emails_total": "Emails queued, by render cache outcome",
+    "hc_email_send_seconds": "Time spent sending a single email over SMTP",
+    "hc_emails_sent_total": "Emails handed to the SMTP server, by outcome",
+    "hc_email_queue_depth": "Emails waiting for a sending thread",
+    "hc_http_request_seconds": "Time spent on a single outgoing HTTP request",
+    "hc_http_requests_total": "Outgoing HTTP requests, by outcome",
+    "hc_shell_seconds": "Time spent running a shell command",
+    "hc_shell_commands_total": "Shell commands run, by outcome",
+    "hc_notify_seconds": "Time spent delivering a notification, by channel kind",
+}
+
+
+class NullTimer(object):
+    """ What Metrics.timer() returns when metrics are disabled. """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+
+    def escape(value):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        return value.replace("\n", "\\n")
+
+    return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in pairs)
+
+
+class Metrics(object):
+    """ Process-wide counters and latency histograms.
+
+    When disabled, every call returns right after checking a flag, and
+    timer() hands out a shared do-nothing context manager, so
+    instrumented code pays next to nothing. Series are keyed by name
+    and labels, and exported in the Prometheus text format.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.counters = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+        # (name, labels) -> function returning the current value
+        self.gauges = {}
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect_left(BUCKETS, value)
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def gauge(self, name, fn, **labels):
+        """ Report fn()'s return value as a gauge whenever rendering. """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = fn
+
+    def timer(self, name, **labels):
+        """ Return a context manager that observes the time spent in it. """
+
+        if not self.enabled:
+            return NULL_TIMER
+
+        return Timer(self, name, labels)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        """ Return all series in the Prometheus text exposition format. """
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self.histograms.items())
+            gauges = sorted(self.gauges.items()) if self.enabled else []
+
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append("# HELP %s %s" % (name, DESCRIPTIONS[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append("%s%s %s" % (name, _format_labels(labels), value))
+
+        for (name, labels), fn in gauges:
+            header(name, "gauge")
+            lines.append("%s%s %s" % (name, _format_labels(labels), fn()))
+
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                le = _format_labels(labels, [("le", bound)])
+                lines.append("%s_bucket%s %d" % (name, le, cumulative))
+            lines.append("%s_sum%s %r" % (name, _format_labels(labels), total))
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(settings.METRICS_ENABLED)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # The same check as the /metrics view
+        if settings.METRICS_TOKEN:
+            auth = self.headers.get("Authorization", "")
+            if not constant_time_compare(auth, "Bearer %s" % settings.METRICS_TOKEN):
+                self.send_error(403)
+                return
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, addr="127.0.0.1"):
+    """ Serve this process's metrics over HTTP from a daemon thread.
+
+    For the long-running commands, whose metrics the web process's
+    /metrics endpoint cannot see. Turns metrics collection on, whatever
+    METRICS_ENABLED says. Listens on localhost unless told otherwise,
+    and asks for METRICS_TOKEN if that is set.
+    """
+
+    metrics.enabled = True
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
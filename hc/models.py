@@ -1,16 +1,112 @@
-from django.db import models
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.db.models import F, Prefetch, Q, Value
+from django.db.models.sql import UpdateQuery
+from django.utils.functional import cached_property
+from django.utils import timezone
 from uuid import uuid4
-from accounts.models import Project
+from accounts.models import Profile, Project
 from datetime import datetime, timedelta
+from django.core.exceptions import ValidationError
+from django.core.signing import Signer
+from django.urls import reverse
+from hc import cron
 from hc.enums import CheckKind, Status, ChannelKind
-from django.contrib.sites.models import Site
-from hc.transport import Email, Http, Shell
+from hc.sites import get_site
+from hc.transport import Email, Http, Shell, TransientError
 import json
+import zlib
 
 DEFAULT_TIMEOUT = timedelta(days=1)
 DEFAULT_GRACE = timedelta(hours=1)
 
 
+def validate_schedule(value):
+    try:
+        cron.validate(value)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+
+def grace_start_at(kind, last_ping, last_start, status, timeout, schedule, tz):
+    """ Return the datetime when a check's grace period starts.
+
+    For simple checks this is the last ping plus the timeout, for cron
+    checks the first scheduled run after the last ping, in timezone tz.
+    A "start" signal without a matching success ping pulls it forward
+    to the start time. Returns None if the check has never pinged.
+    Shared by Check.get_grace_start() and hc.snapshots.
+    """
+
+    result = None
+    if last_ping and kind == CheckKind.simple.name:
+        result = last_ping + timeout
+    elif last_ping and kind == CheckKind.cron.name:
+        result = cron.get_schedule(schedule, tz).next(last_ping)
+
+    if last_start and status != Status.down.name:
+        result = min(result, last_start) if result else last_start
+
+    return result
+
+
+def status_at(status, grace_start, grace, now):
+    """ Return the status a check shows at `now`.
+
+    Adds "grace" to the stored statuses: the check is up, but its grace
+    period has started. Shared by Check.get_status() and hc.snapshots.
+    """
+
+    if status in (Status.new.name, Status.paused.name, Status.down.name):
+        return status
+
+    if grace_start is None:
+        return status
+
+    if now >= grace_start + grace:
+        return Status.down.name
+    if now >= grace_start:
+        return "grace"
+
+    return status
+
+
+def can_return_from_update(conn):
+    if conn.vendor == "postgresql":
+        return True
+
+    # SQLite supports UPDATE ... RETURNING since 3.35
+    return conn.vendor == "sqlite" and conn.Database.sqlite_version_info >= (3, 35)
+
+
+def update_returning(q, fields, column):
+    """ Run q.update(**fields) and return `column` of the updated row.
+
+    Returns None if no row matched. Where the database supports it,
+    the new value comes back from the UPDATE itself; elsewhere it is
+    read in the same transaction, while the UPDATE's row lock keeps
+    other writers from changing it in between.
+    """
+
+    conn = connections[q.db]
+    if can_return_from_update(conn):
+        query = q.query.chain(UpdateQuery)
+        query.add_update_values(fields)
+        sql, params = query.get_compiler(q.db).as_sql()
+        sql += " RETURNING %s" % conn.ops.quote_name(column)
+        with transaction.mark_for_rollback_on_error(using=q.db), conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+
+        return row[0] if row else None
+
+    with transaction.atomic(using=q.db):
+        if not q.update(**fields):
+            return None
+
+        return q.values_list(column, flat=True).first()
+
+
 # Create your models here.
 class Check(models.Model):
     code = models.UUIDField(default=uuid4, unique=True)
@@ -20,7 +116,7 @@ class Check(models.Model):
     kind = models.CharField(max_length=10, default=CheckKind.simple.name, choices=CheckKind.choices())
     timeout = models.DurationField(default=DEFAULT_TIMEOUT)
     grace = models.DurationField(default=DEFAULT_GRACE)
-    schedule = models.CharField(max_length=100, default="* * * * *")
+    schedule = models.CharField(max_length=100, default="* * * * *", validators=[validate_schedule])
     subject_success = models.CharField(max_length=254, blank=True)
     subject_fail = models.CharField(max_length=254, blank=True)
     ping_count = models.IntegerField(default=0)
@@ -29,40 +125,325 @@ class Check(models.Model):
     last_duration = models.DurationField(null=True, blank=True)
     last_ping_was_fail = models.NullBooleanField(default=False)
     alert_after = models.DateTimeField(null=True, blank=True)
+    down_since = models.DateTimeField(null=True, blank=True)
     status = models.CharField(max_length=10, default="new", choices=Status.choices())
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         verbose_name = "Check"
         verbose_name_plural = "Checks"
+        indexes = [
+            # Used by the sendalerts command to find overdue checks
+            models.Index(
+                fields=["status", "alert_after"], name="hc_check_status_alert_after"
+            ),
+            # Used by Transport.checks() to list a project's checks
+            models.Index(
+                fields=["project", "created_at"], name="hc_check_project_created_at"
+            ),
+        ]
 
     def __str__(self):
-        return self.name or self.code
+        return self.name or str(self.code)
+
+    def tags_list(self):
+        return [tag for tag in (self.tags or "").split(" ") if tag]
 
     def url(self):
-        site = Site.objects.first()
-        return "{}/{}".format(site.domain, self.code)
+        return "{}/{}".format(get_site().domain, self.code)
+
+    def get_grace_start(self):
+        """ Return the datetime when the grace period starts.
+
+        See grace_start_at(). Cron schedules use the owner's timezone.
+        """
+
+        # Only cron checks need the owner's timezone, don't load it otherwise
+        tz = None
+        if self.kind == CheckKind.cron.name:
+            tz = self.project.owner.timezone
+
+        return grace_start_at(
+            self.kind,
+            self.last_ping,
+            self.last_start,
+            self.status,
+            self.timeout,
+            self.schedule,
+            tz,
+        )
+
+    def get_status(self, now=None):
+        """ Return "new", "paused", "up", "grace" or "down". """
+
+        return status_at(self.status, self.get_grace_start(), self.grace, now or timezone.now())
+
+    def going_down_after(self):
+        """ Return the datetime when the check goes down, or None. """
+
+        grace_start = self.get_grace_start()
+        if grace_start is not None:
+            return grace_start + self.grace
+
+    def ping(self, remote_addr, scheme, method, ua, body, action):
+        """ Record a ping without loading and saving the whole row.
+
+        Counters and timestamps are applied with a single UPDATE built
+        from F() expressions, so concurrent pings never overwrite each
+        other. Status flips use a conditional UPDATE on the old status,
+        so only one of several racing requests sends the notifications.
+        The Ping row itself is queued in the process-wide ping buffer
+        and written in bulk.
+        """
+
+        now = timezone.now()
+        duration = None
+        if action != "start" and self.last_start:
+            duration = now - self.last_start
+
+        fields = {"ping_count": F("ping_count") + 1}
+        if action == "start":
+            self.last_start = now
+            fields["last_start"] = now
+        else:
+            self.last_ping = now
+            self.last_start = None
+            # The right-hand sides see the old column values, so the
+            # duration is measured against the previous "start" ping.
+            fields["last_ping"] = now
+            fields["last_start"] = None
+            now_value = Value(now, output_field=models.DateTimeField())
+            fields["last_duration"] = now_value - F("last_start")
+            fields["last_ping_was_fail"] = action == "fail"
+
+        # Keep the sendalerts index current, so it never has to
+        # evaluate checks that are not overdue
+        self.alert_after = self.going_down_after()
+        fields["alert_after"] = self.alert_after
+
+        q = Check.objects.filter(id=self.id)
+        self.ping_count = update_returning(q, fields, "ping_count")
+
+        if action != "start":
+            new_status = Status.down.name if action == "fail" else Status.up.name
+            self.flip(new_status)
+
+        # Numbered from this ping's own increment, so pings buffered in
+        # other processes never get the same number
+        ping = Ping(owner=self, created_at=now, count=self.ping_count)
+        ping.queue(remote_addr, scheme, method, ua, body, action, duration)
+
+    @staticmethod
+    def quick_ping(record, remote_addr, scheme, method, ua, body, action):
+        """ Record a ping that changes nothing but counters and timestamps.
+
+        Works from a CheckRecord (see hc.registry) instead of the row:
+        a single UPDATE applies the ping only if the check already has
+        the status the ping would give it and no "start" is pending.
+        Returns False, having changed nothing, if that is not the case
+        or if the ping is a "start"; use Check.ping() then.
+        """
+
+        if action == "start":
+            return False
+
+        now = timezone.now()
+        if record.kind == CheckKind.cron.name:
+            grace_start = cron.get_schedule(record.schedule, record.tz).next(now)
+        else:
+            grace_start = now + record.timeout
+
+        new_status = Status.down.name if action == "fail" else Status.up.name
+        q = Check.objects.filter(id=record.id, status=new_status, last_start=None)
+        fields = {
+            "ping_count": F("ping_count") + 1,
+            "last_ping": now,
+            "last_duration": None,
+            "last_ping_was_fail": action == "fail",
+            "alert_after": grace_start + record.grace,
+        }
+        n = update_returning(q, fields, "ping_count")
+        if n is None:
+            return False
+
+        ping = Ping(owner_id=record.id, created_at=now, count=n)
+        ping.queue(remote_addr, scheme, method, ua, body, action, None)
+        return True
+
+    def flip(self, new_status):
+        """ Move the check to new_status and notify its channels.
+
+        Returns True if this call performed the transition. New and
+        paused checks coming up are not announced.
+        """
+
+        old_status = self.status
+        if old_status == new_status:
+            return False
+
+        now = timezone.now()
+        down_since = now if new_status == Status.down.name else None
+        # The alerts are queued in the same transaction as the status
+        # change, so a check never flips without them
+        with transaction.atomic():
+            q = Check.objects.filter(id=self.id, status=old_status)
+            if not q.update(status=new_status, down_since=down_since):
+                # Somebody else got there first
+                return False
+
+            if old_status == Status.down.name and self.down_since:
+                from hc import rollups
+
+                rollups.record_downtime(self.id, self.down_since, now)
+
+            self.status, self.down_since = new_status, down_since
+            if new_status == Status.up.name and old_status in (
+                Status.new.name,
+                Status.paused.name,
+            ):
+                return True
+
+            self.send_alert()
+
+        return True
+
+    def send_alert(self):
+        """ Queue notifications for every channel assigned to this check.
+
+        The notifyworker command delivers them. Channels of kinds that
+        have no transport get a notification that records the error
+        instead of being queued.
+        """
+
+        # One timestamp for the whole batch: it tells the deliveries of
+        # this status change apart from those of any other
+        now = timezone.now()
+        notifications = []
+        for channel in self.channel_set.all():
+            n = Notification(owner=self, channel=channel, check_status=self.status)
+            n.created_at = now
+            if not channel.has_transport():
+                n.error = channel.unsupported_error()
+            elif channel.transport.is_noop(self):
+                continue
+            else:
+                n.pending = True
+
+            notifications.append(n)
+
+        Notification.objects.bulk_create(notifications)
+
+        ids = [n.channel_id for n in notifications]
+        Channel.objects.filter(id__in=ids).update(notification_count=F("notification_count") + 1)
 
 
 class Ping(models.Model):
     id = models.BigAutoField(primary_key=True)
     count = models.IntegerField(default=0)
-    owner = models.ForeignKey(to=Check, on_delete=models.CASCADE)
+    # Indexed by the composite indexes below, which start with owner
+    owner = models.ForeignKey(to=Check, on_delete=models.CASCADE, db_index=False)
     kind = models.CharField(max_length=6, blank=True, null=True)
     scheme = models.CharField(max_length=10, default="http")
     remote_addr = models.GenericIPAddressField(blank=True, null=True)
     method = models.CharField(max_length=10, blank=True)
     ua = models.CharField(max_length=254, blank=True)
     body = models.TextField(blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # zlib-compressed body, used instead of `body` for long bodies
+    body_raw = models.BinaryField(null=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         verbose_name = "Ping"
         verbose_name_plural = "Pings"
+        indexes = [
+            # A check's pings, newest first, and pruning by id
+            models.Index(fields=["owner", "id"], name="hc_ping_owner_ping_id"),
+            # A check's pings within a time range
+            models.Index(fields=["owner", "created_at"], name="hc_ping_owner_created_at"),
+        ]
 
     def __str__(self):
         return "{}:{}".format(self.owner, self.id)
 
+    def set_body(self, body):
+        """ Store the request body, compressed if it is long.
+
+        Bodies longer than PING_BODY_COMPRESS_THRESHOLD bytes go to
+        body_raw, unless compressing does not make them any shorter.
+        Returns True if the body was compressed.
+        """
+
+        self.body, self.body_raw = body, None
+        if not body:
+            return False
+
+        data = body.encode()
+        if len(data) <= settings.PING_BODY_COMPRESS_THRESHOLD:
+            return False
+
+        compressed = zlib.compress(data)
+        if len(compressed) >= len(data):
+            return False
+
+        self.body, self.body_raw = None, compressed
+        return True
+
+    def queue(self, remote_addr, scheme, method, ua, body, action, duration):
+        """ Fill in the request details and hand the ping to the ping buffer. """
+
+        self.kind = action if action in ("start", "fail") else None
+        self.scheme = scheme
+        self.remote_addr = remote_addr
+        self.method = method
+        # If User-Agent is longer than 200 characters, truncate it:
+        self.ua = ua[:200]
+        self.set_body(body)
+        # Not stored on the row, the ping buffer adds it to the rollups
+        self.duration = duration
+
+        from hc.buffers import pings
+
+        pings.add(self)
+
+    def get_body(self):
+        if self.body_raw is not None:
+            return zlib.decompress(self.body_raw).decode()
+
+        return self.body
+
+
+class Rollup(models.Model):
+    """ Ping and downtime totals of one check over one hour or day.
+
+    Maintained by hc.rollups as pings are written and checks come back
+    up; the rebuildrollups command recomputes the ping totals.
+    """
+
+    owner = models.ForeignKey(to=Check, on_delete=models.CASCADE)
+    period = models.CharField(max_length=4, choices=(("hour", "Hour"), ("day", "Day")))
+    start = models.DateTimeField()
+    n_pings = models.IntegerField(default=0)
+    n_fails = models.IntegerField(default=0)
+    # Durations (in seconds) between a "start" ping and the next success
+    # or fail ping. Seconds rather than DurationField, so that the totals
+    # can be incremented in place on every backend.
+    n_durations = models.IntegerField(default=0)
+    total_duration = models.FloatField(default=0)
+    min_duration = models.FloatField(null=True)
+    max_duration = models.FloatField(null=True)
+    downtime = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["owner", "period", "start"], name="hc_rollup_owner_period_start"
+            ),
+        ]
+
+    def avg_duration(self):
+        if self.n_durations:
+            return self.total_duration / self.n_durations
+
 
 class Channel(models.Model):
     code = models.UUIDField(default=uuid4, unique=True)
@@ -72,6 +453,9 @@ class Channel(models.Model):
     value = models.TextField(blank=True)
     email_verified = models.BooleanField(default=False)
     last_error = models.CharField(max_length=200, blank=True)
+    # Notifications ever queued for this channel, kept up to date as
+    # they are queued so the admin doesn't have to count them
+    notification_count = models.IntegerField(default=0)
     checks = models.ManyToManyField(to=Check)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -86,7 +470,13 @@ class Channel(models.Model):
         checks = Check.objects.filter(project=self.project)
         self.checks.add(*checks)
 
-    @property
+    def has_transport(self):
+        return self.kind in ("email", "shell")
+
+    def unsupported_error(self):
+        return "Unsupported channel kind: %s" % self.kind
+
+    @cached_property
     def transport(self):
         if self.kind == "email":
             return Email(self)
@@ -96,31 +486,45 @@ class Channel(models.Model):
             raise NotImplementedError("Unknown channel kind %s", self.kind)
 
     def notify(self, check):
-        if self.transport.is_noop(check):
-            return "no-op"
+        """ Queue a notification about check's current status.
+
+        Returns the queued Notification, or None if this channel ignores
+        the status. The notifyworker command delivers it. Without a
+        transport for this kind, the notification just records an error.
+        """
 
         notification = Notification(channel=self)
+        if not self.has_transport():
+            notification.error = self.unsupported_error()
+        elif self.transport.is_noop(check):
+            return None
+        else:
+            notification.pending = True
+
         notification.owner = check
         notification.check_status = check.status
-        notification.error = "Sending"
         notification.save()
 
-        if self.kind == "email":
-            error = self.transport.notify(check, notification.bounce_url()) or ""
-        else:
-            error = self.transport.notify(check) or ""
+        q = Channel.objects.filter(id=self.id)
+        q.update(notification_count=F("notification_count") + 1)
+        return notification
 
-        notification.error = error
-        notification.save()
+    @property
+    def json(self):
+        """ Return the parsed channel value.
 
-        self.last_error = error
-        self.save()
+        Each distinct value is parsed once per instance. The cached copy
+        is keyed by the raw string, so assigning a new value, saving or
+        reloading the row is picked up on the next access. Don't modify
+        the returned object.
+        """
 
-        return error
+        cached = self.__dict__.get("_json")
+        if cached is None or cached[0] != self.value:
+            cached = (self.value, json.loads(self.value))
+            self._json = cached
 
-    @property
-    def json(self):
-        return json.loads(self.value)
+        return cached[1]
 
     @property
     def cmd_down(self):
@@ -132,24 +536,57 @@ class Channel(models.Model):
         if self.kind == "shell":
             return self.json["cmd_up"]
 
+    @property
+    def email_value(self):
+        if self.kind == "email":
+            if not self.value.startswith("{"):
+                return self.value
+            return self.json["value"]
+
     @property
     def email_notify_down(self):
         if self.kind == "email":
             if not self.value.startswith("{"):
                 return True
-            val = json.loads(self.value)
-            return val.get("down")
+            return self.json.get("down")
 
     @property
     def email_notify_up(self):
         if self.kind == "email":
             if not self.value.startswith("{"):
                 return True
-            val = json.loads(self.value)
-            return val.get("up")
+            return self.json.get("up")
+
+    def get_unsub_link(self):
+        """ Return the absolute URL that unsubscribes this email channel.
+
+        One-click unsubscribe (RFC 8058) needs an https URL, so the
+        scheme comes from SITE_SCHEME.
+        """
+
+        token = Signer(salt="alerts").sign(str(self.code))
+        path = reverse("hc-unsubscribe-alerts", args=[token])
+        return "{}://{}{}".format(settings.SITE_SCHEME, get_site().domain, path)
 
     def latest_notification(self):
-        return Notification.objects.filter(channel=self).latest()
+        """ Return the newest notification of this channel, or None. """
+
+        q = Notification.objects.filter(channel=self)
+        return q.order_by("-created_at").first()
+
+
+class NotificationQuerySet(models.QuerySet):
+    def for_delivery(self):
+        """ Load everything delivery reads in a fixed number of queries.
+
+        Channels, projects and checks are joined in, and the check
+        listings of all involved projects come from one extra query.
+        Use Notification.prefetch_sorts() on the result as well.
+        """
+
+        checks = Check.objects.order_by("created_at")
+        listing = Prefetch("channel__project__check_set", checks, to_attr="checks_by_created")
+        return self.select_related("channel__project", "owner").prefetch_related(listing)
 
 
 class Notification(models.Model):
@@ -157,8 +594,77 @@ class Notification(models.Model):
     owner = models.ForeignKey(to=Check, on_delete=models.CASCADE, null=True)
     check_status = models.CharField(max_length=6)
     channel = models.ForeignKey(to=Channel, on_delete=models.CASCADE)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     error = models.CharField(max_length=200, blank=True)
+    pending = models.BooleanField(default=False)
+    lease_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+
+    objects = NotificationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Used by the notifyworker command to find queued notifications
+            models.Index(
+                fields=["id"], name="hc_notification_pending", condition=Q(pending=True)
+            ),
+            # Used by Channel.latest_notification()
+            models.Index(
+                fields=["channel", "created_at"], name="hc_notification_chan_created"
+            ),
+        ]
 
     def bounce_url(self):
         return None
+
+    @staticmethod
+    def prefetch_sorts(notifications):
+        """ Look up the sort preference of all email recipients at once.
+
+        The result is stored on each email channel as `recipient_sort`,
+        which the Email transport uses instead of a per-recipient query.
+        """
+
+        channels = [n.channel for n in notifications if n.channel.kind == "email"]
+        if not channels:
+            return
+
+        emails = {channel.email_value for channel in channels}
+        q = Profile.objects.filter(user__email__in=emails)
+        sorts = dict(q.values_list("user__email", "sort"))
+        for channel in channels:
+            # Default sort order is by check's creation time
+            channel.recipient_sort = sorts.get(channel.email_value, "created")
+
+    def deliver(self):
+        """ Send this notification and record the outcome.
+
+        Returns an error message, or an empty string on success. After a
+        TransientError the notification stays pending and leased, and
+        notifyworker tries again once the lease runs out.
+        """
+
+        channel, check = self.channel, self.owner
+        # Report the status the check had when the notification was
+        # queued, not whatever it is now
+        check.status = self.check_status
+
+        try:
+            if not channel.has_transport():
+                error = channel.unsupported_error()
+            elif channel.kind == "email":
+                error = channel.transport.notify(check, self.bounce_url(), self.created_at) or ""
+            else:
+                error = channel.transport.notify(check) or ""
+        except TransientError as e:
+            error = str(e)[:200]
+            self.error = error
+            self.save(update_fields=["error"])
+            Channel.objects.filter(id=channel.id).update(last_error=error)
+            return error
+
+        error = error[:200]
+        self.error, self.pending, self.lease_until = error, False, None
+        self.save(update_fields=["error", "pending", "lease_until"])
+        Channel.objects.filter(id=channel.id).update(last_error=error)
+        return error
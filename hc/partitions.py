@@ -0,0 +1,204 @@
+import re
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from hc.models import Ping
+
+TABLE = Ping._meta.db_table
+LEGACY = TABLE + "_legacy"
+DEFAULT = TABLE + "_default"
+
+# Upper bound of a partition, as printed by pg_get_expr()
+UPPER_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+
+def period_start(dt, period):
+    """ Return the start of the day or month containing dt, in UTC. """
+
+    dt = dt.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "month":
+        dt = dt.replace(day=1)
+
+    return dt
+
+
+def period_end(start, period):
+    if period == "day":
+        return start + timedelta(days=1)
+
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+
+    return start.replace(month=start.month + 1)
+
+
+def partition_name(start, period):
+    fmt = "%Y%m%d" if period == "day" else "%Y%m"
+    return "%s_p%s" % (TABLE, start.strftime(fmt))
+
+
+def supported():
+    """ Return True if the database can partition the ping table.
+
+    Only PostgreSQL can. Everywhere else, including SQLite in
+    development, the ping table stays a plain table.
+    """
+
+    return connection.vendor == "postgresql"
+
+
+def is_partitioned():
+    if not supported():
+        return False
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = %s",
+            [TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def convert(period, now=None):
+    """ Turn the plain ping table into one partitioned by created_at.
+
+    The existing table is renamed and attached as the partition for
+    everything up to the end of the current period, so no rows are
+    copied. The primary key becomes (id, created_at), as PostgreSQL
+    requires the partition key in every unique index; the id sequence
+    carries over. Attaching scans the old table once to validate its
+    range, and once more to build its part of the new primary key.
+    """
+
+    end = period_end(period_start(now or timezone.now(), period), period)
+    fk = Ping._meta.get_field("owner")
+    target = fk.remote_field.model._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (TABLE, LEGACY))
+        # The old primary key on (id) alone can't stay: a partition may
+        # only have the parent's, and its name is needed for that one
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'",
+            [LEGACY],
+        )
+        for (name,) in cursor.fetchall():
+            cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (LEGACY, name))
+        cursor.execute(
+            "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+            % (TABLE, LEGACY)
+        )
+        cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, created_at)" % TABLE)
+        cursor.execute(
+            "ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s (id) "
+            "DEFERRABLE INITIALLY DEFERRED" % (TABLE, fk.column, target)
+        )
+        for index in Ping._meta.indexes:
+            # Index names are unique per schema. The old table's copy
+            # is renamed, and attaching adopts it as the partition's.
+            columns = [Ping._meta.get_field(f).column for f in index.fields]
+            cursor.execute("ALTER INDEX %s RENAME TO %s_l" % (index.name, index.name))
+            cursor.execute(
+                "CREATE INDEX %s ON %s (%s)" % (index.name, TABLE, ", ".join(columns))
+            )
+        cursor.execute("ALTER SEQUENCE %s_id_seq OWNED BY %s.id" % (TABLE, TABLE))
+        cursor.execute(
+            "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%%s)"
+            % (TABLE, LEGACY),
+            [end],
+        )
+        # Catches rows outside every partition instead of failing the
+        # insert, should create_partitions() not have run in time
+        cursor.execute("CREATE TABLE %s PARTITION OF %s DEFAULT" % (DEFAULT, TABLE))
+
+
+def create_partitions(period, ahead, now=None):
+    """ Create partitions for the current and the next `ahead` periods.
+
+    Periods already covered, for example by the converted legacy
+    table, are skipped. Returns the names of the partitions created.
+    """
+
+    start = period_start(now or timezone.now(), period)
+    last = start
+    for i in range(ahead + 1):
+        last = period_end(last, period)
+
+    bounds = [upper for name, upper in list_partitions()]
+    if bounds and bounds[-1] > start:
+        start = bounds[-1]
+
+    created = []
+    with connection.cursor() as cursor:
+        while start < last:
+            end = period_end(start, period)
+            name = partition_name(start, period)
+            cursor.execute(
+                "CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)"
+                % (name, TABLE),
+                [start, end],
+            )
+            created.append(name)
+            start = end
+
+    return created
+
+
+def list_partitions():
+    """ Return (name, upper bound) for every bounded partition, oldest first. """
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s",
+            [TABLE],
+        )
+        rows = cursor.fetchall()
+
+    result = []
+    for name, bound in rows:
+        m = UPPER_BOUND_RE.search(bound)
+        if m:
+            result.append((name, parse_datetime(m.group(1))))
+
+    return sorted(result, key=lambda item: item[1])
+
+
+def drop_partitions(before, dry_run=False):
+    """ Drop partitions holding only pings older than `before`.
+
+    Dropping a partition is a catalog change, so retention costs the
+    same whatever the number of rows. Returns the names dropped.
+    """
+
+    dropped = []
+    for name, upper in list_partitions():
+        if upper > before:
+            break
+
+        if not dry_run:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE %s" % name)
+        dropped.append(name)
+
+    return dropped
+
+
+def delete_before(before, chunk_size):
+    """ Delete pings older than `before` in id ranges.
+
+    The fallback for unpartitioned tables. Returns the number deleted.
+    """
+
+    q = Ping.objects.filter(created_at__lt=before)
+    deleted = 0
+    while True:
+        ids = list(q.order_by("id").values_list("id", flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+
+        num, _ = q.filter(id__range=(ids[0], ids[-1])).delete()
+        deleted += num
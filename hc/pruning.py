@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from hc.models import Check
+from subscriptions.models import Plan
+
+
+class PruneCommand(BaseCommand):
+    """ Base for commands that keep only the newest rows per check.
+
+    Subclasses set `model`, a model with an `owner` foreign key to Check.
+    Rows are deleted per check, oldest first, in id ranges of at most
+    --chunk-size rows, so no single statement holds locks for long.
+    """
+
+    model = None
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many rows would be deleted",
+        )
+
+    def get_checks(self):
+        """ Return (check id, plan id) pairs for checks worth visiting. """
+
+        q = Check.objects.order_by("id")
+        return q.values_list("id", "project__owner__subscription__plan_id")
+
+    def prune(self, check_id, keep, chunk_size, dry_run):
+        q = self.model.objects.filter(owner_id=check_id)
+        cutoff = list(q.order_by("-id").values_list("id", flat=True)[keep : keep + 1])
+        if not cutoff:
+            return 0
+
+        old = q.filter(id__lte=cutoff[0])
+        if dry_run:
+            return old.count()
+
+        deleted = 0
+        while True:
+            ids = list(old.order_by("id").values_list("id", flat=True)[:chunk_size])
+            if not ids:
+                return deleted
+
+            num, _ = old.filter(id__range=(ids[0], ids[-1])).delete()
+            deleted += num
+
+    def handle(self, *args, **options):
+        limits = {plan.id: plan.ping_log_limit for plan in Plan.objects.all()}
+        name = self.model._meta.verbose_name_plural.lower()
+
+        visited, total = 0, 0
+        for check_id, plan_id in self.get_checks().iterator():
+            keep = limits.get(plan_id, settings.PING_LOG_LIMIT)
+            total += self.prune(check_id, keep, options["chunk_size"], options["dry_run"])
+
+            visited += 1
+            if visited % 1000 == 0:
+                self.stdout.write("Visited %d checks, %d %s so far" % (visited, total, name))
+
+        verb = "Would delete" if options["dry_run"] else "Deleted"
+        return "%s %d %s" % (verb, total, name)
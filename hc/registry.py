@@ -0,0 +1,114 @@
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from accounts.models import Profile
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from hc.models import Check
+from hc.utils import cache_is_shared
+
+# What the ping view needs to know about a check without reading its row.
+# Status and timestamps are deliberately left out: they change with every
+# ping, so Check.quick_ping() checks them in its UPDATE instead.
+CheckRecord = namedtuple("CheckRecord", ("id", "kind", "timeout", "grace", "schedule", "tz"))
+
+FIELDS = ("id", "kind", "timeout", "grace", "schedule", "project__owner__timezone")
+
+# Bumped in the shared cache whenever a check changes, so that other
+# processes notice and start over
+VERSION_KEY = "hc-registry-version"
+
+# Cached in place of a record for codes that match no check
+MISSING = object()
+
+
+class CheckRegistry(object):
+    """ Process-wide LRU cache of CheckRecords by check code.
+
+    Entries expire after `ttl` seconds, and unknown codes are remembered
+    for `negative_ttl` seconds, so floods of pings to deleted checks are
+    answered without touching the database. Saving or deleting a check
+    clears this process's copy right away, and other processes' copies
+    at most CHECK_REGISTRY_CHECK_INTERVAL seconds later: that is how
+    often the shared version key is compared. That needs a cache shared
+    between processes; without one, entries are kept no longer than
+    CHECK_REGISTRY_CHECK_INTERVAL seconds instead.
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl):
+        if not cache_is_shared():
+            ttl = min(ttl, settings.CHECK_REGISTRY_CHECK_INTERVAL)
+            negative_ttl = min(negative_ttl, settings.CHECK_REGISTRY_CHECK_INTERVAL)
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = Lock()
+        self.items = OrderedDict()
+        self.version = None
+        self.checked = 0.0
+
+    def _check_version(self, now):
+        if now - self.checked < settings.CHECK_REGISTRY_CHECK_INTERVAL:
+            return
+
+        version = cache.get(VERSION_KEY)
+        with self.lock:
+            if version != self.version:
+                self.items.clear()
+                self.version = version
+            self.checked = now
+
+    def get(self, code):
+        """ Return the CheckRecord for a code, or None if there's no such check. """
+
+        now = time.monotonic()
+        self._check_version(now)
+        with self.lock:
+            item = self.items.get(code)
+            if item and item[0] > now:
+                self.items.move_to_end(code)
+                return None if item[1] is MISSING else item[1]
+
+        # Query outside the lock; a concurrent miss queries twice
+        row = Check.objects.filter(code=code).values_list(*FIELDS).first()
+        if row is None:
+            value, expires = MISSING, now + self.negative_ttl
+        else:
+            value, expires = CheckRecord(*row), now + self.ttl
+
+        with self.lock:
+            self.items[code] = (expires, value)
+            self.items.move_to_end(code)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+        return None if value is MISSING else value
+
+    def invalidate(self):
+        with self.lock:
+            self.items.clear()
+
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            # The key is missing or has been evicted
+            cache.set(VERSION_KEY, 1, None)
+
+
+registry = CheckRegistry(
+    settings.CHECK_REGISTRY_SIZE,
+    settings.CHECK_REGISTRY_TTL,
+    settings.CHECK_REGISTRY_NEGATIVE_TTL,
+)
+
+
+@receiver(post_save, sender=Check)
+@receiver(post_delete, sender=Check)
+@receiver(post_save, sender=Profile)
+def invalidate_registry(sender, **kwargs):
+    # A profile's timezone is part of its checks' records
+    registry.invalidate()
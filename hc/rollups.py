@@ -0,0 +1,152 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce, Greatest, Least
+from hc.models import Rollup
+
+PERIODS = ("hour", "day")
+
+
+def period_start(dt, period):
+    """ Return the start of the UTC hour or day containing dt. """
+
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if period == "day":
+        dt = dt.replace(hour=0)
+
+    return dt
+
+
+def period_length(period):
+    return timedelta(hours=1) if period == "hour" else timedelta(days=1)
+
+
+class Totals(object):
+    """ Amounts to add to one rollup row. """
+
+    __slots__ = ("pings", "fails", "durations", "downtime")
+
+    def __init__(self):
+        self.pings = 0
+        self.fails = 0
+        self.durations = []
+        self.downtime = 0.0
+
+    def add_ping(self, ping):
+        self.pings += 1
+        if ping.kind == "fail":
+            self.fails += 1
+
+        duration = getattr(ping, "duration", None)
+        if duration is not None:
+            self.durations.append(duration.total_seconds())
+
+
+def _apply(owner_id, period, start, totals):
+    """ Add totals to a rollup row, creating the row if needed.
+
+    The row is changed with a single UPDATE of F() expressions, so
+    concurrent writers never lose each other's increments.
+    """
+
+    fields = {
+        "n_pings": F("n_pings") + totals.pings,
+        "n_fails": F("n_fails") + totals.fails,
+    }
+    if totals.durations:
+        lo, hi = min(totals.durations), max(totals.durations)
+        fields["n_durations"] = F("n_durations") + len(totals.durations)
+        fields["total_duration"] = F("total_duration") + sum(totals.durations)
+        # On SQLite, MIN() and MAX() of anything and NULL are NULL
+        fields["min_duration"] = Least(Coalesce(F("min_duration"), lo), lo)
+        fields["max_duration"] = Greatest(Coalesce(F("max_duration"), hi), hi)
+    if totals.downtime:
+        fields["downtime"] = F("downtime") + totals.downtime
+
+    q = Rollup.objects.filter(owner_id=owner_id, period=period, start=start)
+    if q.update(**fields):
+        return
+
+    try:
+        with transaction.atomic():
+            Rollup.objects.create(
+                owner_id=owner_id,
+                period=period,
+                start=start,
+                n_pings=totals.pings,
+                n_fails=totals.fails,
+                n_durations=len(totals.durations),
+                total_duration=sum(totals.durations),
+                min_duration=min(totals.durations, default=None),
+                max_duration=max(totals.durations, default=None),
+                downtime=totals.downtime,
+            )
+    except IntegrityError:
+        # Another process created the row in the meantime
+        q.update(**fields)
+
+
+def aggregate_pings(pings):
+    """ Return {(owner_id, period, start): Totals} for the given pings. """
+
+    result = defaultdict(Totals)
+    for ping in pings:
+        for period in PERIODS:
+            key = (ping.owner_id, period, period_start(ping.created_at, period))
+            result[key].add_ping(ping)
+
+    return result
+
+
+def record_pings(pings):
+    """ Add freshly written pings to the rollups.
+
+    The ping buffer calls this once per batch, so a busy check costs one
+    UPDATE per period per batch rather than per ping. Rows are updated
+    in key order, so concurrent batches that touch the same rows lock
+    them in the same order and cannot deadlock.
+    """
+
+    for (owner_id, period, start), totals in sorted(aggregate_pings(pings).items()):
+        _apply(owner_id, period, start, totals)
+
+
+def record_downtime(owner_id, since, until):
+    """ Add the downtime between since and until to the rollups. """
+
+    for period in PERIODS:
+        start = period_start(since, period)
+        while start < until:
+            end = start + period_length(period)
+            totals = Totals()
+            totals.downtime = (min(end, until) - max(start, since)).total_seconds()
+            _apply(owner_id, period, start, totals)
+            start = end
+
+
+def summary(check, since, until, period="day"):
+    """ Return ping and downtime totals of a check over a time range.
+
+    Reads one rollup row per period in the range. Rows are included
+    whole, so the range is effectively rounded out to period bounds.
+    An ongoing outage is counted up to `until`. Downtime is in seconds.
+    """
+
+    q = Rollup.objects.filter(
+        owner_id=check.id, period=period, start__gte=period_start(since, period), start__lt=until
+    )
+    result = q.aggregate(
+        n_pings=Coalesce(Sum("n_pings"), 0),
+        n_fails=Coalesce(Sum("n_fails"), 0),
+        downtime=Coalesce(Sum("downtime"), 0.0),
+    )
+
+    if check.down_since and check.down_since < until:
+        ongoing = until - max(check.down_since, since)
+        result["downtime"] += ongoing.total_seconds()
+
+    total = (until - since).total_seconds()
+    result["uptime"] = max(1 - result["downtime"] / total, 0.0)
+    return result
@@ -0,0 +1,91 @@
+import os
+import signal
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+
+from django.conf import settings
+from hc.metrics import metrics
+
+# How much of a command's output is kept, from the end
+OUTPUT_TAIL = 1000
+
+
+class CommandRunner(object):
+    """ Runs shell commands with a timeout and concurrency limits.
+
+    At most `concurrency` commands run at a time in this process, and at
+    most `per_project` of them for any one project, so a project with a
+    slow hook cannot hold up everybody else's. A command still running
+    after `timeout` seconds is killed, together with any processes it
+    started.
+    """
+
+    def __init__(self, concurrency, per_project, timeout):
+        self.slots = BoundedSemaphore(concurrency)
+        self.per_project = per_project
+        self.timeout = timeout
+        self.lock = Lock()
+        # project id -> [semaphore, number of threads using it]
+        self.projects = {}
+
+    @contextmanager
+    def _project_slot(self, project_id):
+        with self.lock:
+            entry = self.projects.setdefault(
+                project_id, [BoundedSemaphore(self.per_project), 0]
+            )
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.projects[project_id]
+
+    def run(self, cmd, env, project_id):
+        """ Run cmd with /bin/sh and return (exit code, output).
+
+        The exit code is None if the command timed out. Only the last
+        OUTPUT_TAIL bytes of stdout and stderr are returned.
+        """
+
+        with self._project_slot(project_id), self.slots, metrics.timer("hc_shell_seconds"):
+            # Output goes to a file, so a chatty command can neither
+            # fill up memory nor block on a full pipe
+            with tempfile.TemporaryFile() as output:
+                proc = subprocess.Popen(
+                    ["/bin/sh", "-c", cmd],
+                    stdin=subprocess.DEVNULL,
+                    stdout=output,
+                    stderr=subprocess.STDOUT,
+                    env=env,
+                    # Its own process group, so a timeout kills it whole
+                    start_new_session=True,
+                )
+                try:
+                    code = proc.wait(self.timeout)
+                except subprocess.TimeoutExpired:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    proc.wait()
+                    code = None
+
+                size = output.seek(0, os.SEEK_END)
+                output.seek(max(size - OUTPUT_TAIL, 0))
+                tail = output.read().decode(errors="replace")
+
+        if code is None:
+            metrics.inc("hc_shell_commands_total", outcome="timeout")
+        else:
+            metrics.inc("hc_shell_commands_total", outcome="ok" if code == 0 else "error")
+
+        return code, tail.strip()
+
+
+runner = CommandRunner(
+    settings.SHELL_CONCURRENCY, settings.SHELL_PROJECT_CONCURRENCY, settings.SHELL_TIMEOUT
+)
@@ -0,0 +1,75 @@
+import time
+from collections import namedtuple
+from threading import Lock
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from hc.utils import cache_is_shared
+
+SiteInfo = namedtuple("SiteInfo", ("domain", "name"))
+
+# Bumped in the shared cache whenever a Site changes, so that other
+# processes notice and reload
+VERSION_KEY = "hc-site-version"
+
+
+class SiteCache(object):
+    """ Process-wide copy of the current site's domain and name.
+
+    The copy is reloaded when this process saves or deletes a Site, and
+    at most SITE_CACHE_CHECK_INTERVAL seconds after another process did:
+    that is how often the shared version key is compared. If the cache
+    isn't shared between processes, the version key can't tell, and the
+    copy is simply reloaded that often.
+    """
+
+    def __init__(self):
+        self.shared = cache_is_shared()
+        self.lock = Lock()
+        self.info = None
+        self.version = None
+        self.checked = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        info = self.info
+        if info is not None and now - self.checked < settings.SITE_CACHE_CHECK_INTERVAL:
+            return info
+
+        with self.lock:
+            version = cache.get(VERSION_KEY)
+            if self.info is None or version != self.version or not self.shared:
+                site = Site.objects.first()
+                self.info = SiteInfo(site.domain, site.name)
+                self.version = version
+
+            self.checked = now
+            return self.info
+
+    def invalidate(self):
+        with self.lock:
+            self.info = None
+
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            # The key is missing or has been evicted
+            cache.set(VERSION_KEY, 1, None)
+
+
+site_cache = SiteCache()
+
+
+def get_site():
+    """ Return the current site's domain and name as a SiteInfo. """
+
+    return site_cache.get()
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def invalidate_site_cache(sender, **kwargs):
+    site_cache.invalidate()
@@ -0,0 +1,54 @@
+from django.utils import timezone
+from hc.models import grace_start_at, status_at
+
+FIELDS = ("id", "code", "kind", "timeout", "grace", "schedule", "status")
+FIELDS += ("last_ping", "last_start", "project__owner__timezone")
+
+
+class CheckSnapshot(object):
+    """ The columns status evaluation needs, read with values_list().
+
+    A fraction of the size of a Check instance and much cheaper to
+    create: no model machinery, no field descriptors, no per-instance
+    __dict__.
+    """
+
+    __slots__ = FIELDS[:-1] + ("tz",)
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+    def get_grace_start(self):
+        """ Same as Check.get_grace_start(). """
+
+        return grace_start_at(
+            self.kind,
+            self.last_ping,
+            self.last_start,
+            self.status,
+            self.timeout,
+            self.schedule,
+            self.tz,
+        )
+
+    def get_status(self, now):
+        return status_at(self.status, self.get_grace_start(), self.grace, now)
+
+
+def snapshots(queryset, chunk_size=2000):
+    """ Yield a CheckSnapshot for every check in the queryset. """
+
+    for row in queryset.values_list(*FIELDS).iterator(chunk_size=chunk_size):
+        yield CheckSnapshot(row)
+
+
+def statuses(queryset, now=None):
+    """ Return {check id: status} for every check in the queryset.
+
+    Statuses are computed as of a single `now`, in one pass. Cron
+    schedules are parsed once per distinct expression and timezone.
+    """
+
+    now = now or timezone.now()
+    return {snapshot.id: snapshot.get_status(now) for snapshot in snapshots(queryset)}
@@ -0,0 +1,19 @@
+from django import template
+
+register = template.Library()
+
+
+@register.filter
+def sortchecks(checks, key):
+    """ Sort checks by a Profile.sort value: "name", "last_ping" or "created". """
+
+    if key == "name":
+        return sorted(checks, key=lambda check: (check.name.lower(), check.created_at))
+
+    if key == "last_ping":
+        # Most recently pinged first, never pinged last
+        pinged = [check for check in checks if check.last_ping]
+        never = [check for check in checks if not check.last_ping]
+        return sorted(pinged, key=lambda check: check.last_ping, reverse=True) + never
+
+    return sorted(checks, key=lambda check: check.created_at)
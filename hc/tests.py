@@ -1,3 +1,1512 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+from datetime import datetime, time, timedelta
+from io import StringIO
+from smtplib import SMTPException
+from unittest import skipUnless
+from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+from uuid import uuid4
 
-# Create your tests here.
+import requests
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.signing import Signer
+from django.db import DatabaseError, IntegrityError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from accounts.models import Profile, Project
+from hc.admin import ChecksAdmin, EstimatedCountPaginator
+from hc import partitions, rollups, sites
+from hc.bench import scratch_project
+from hc.buffers import PingBuffer
+from hc.cron import CronSchedule
+from hc.emails import Email, pool, render_cache
+from hc.management.commands.notifyworker import Command as NotifyWorker
+from hc.management.commands.prunepings import Command as PrunePings
+from hc.metrics import NULL_TIMER, metrics, serve
+from hc.models import Channel, Check, Notification, Ping, Rollup
+from hc.registry import CheckRegistry, registry
+from hc.shell import runner
+from hc.sites import SiteCache, get_site
+from hc.transport import Http
+from hc.snapshots import statuses
+from hc.utils import replace
+from subscriptions.models import Plan, Subscription
+
+
+class BaseTestCase(TestCase):
+    """ Creates alice, with her profile and a project. """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username="alice", email="alice@example.org")
+        self.profile = Profile.objects.create(user=self.alice)
+        self.project = Project.objects.create(owner=self.profile)
+
+
+@patch("hc.transport.em")
+class NotificationDeliveryQueriesTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        render_cache.clear()
+        # Load the site domain used in unsubscribe links up front
+        get_site()
+
+        self.profile.sort = "name"
+        self.profile.save()
+        self.check = Check.objects.create(project=self.project, status="down")
+        Check.objects.create(project=self.project)
+
+    def queue(self, n):
+        for i in range(n):
+            email = "user%d@example.org" % i
+            channel = Channel.objects.create(
+                project=self.project, kind="email", value=email, email_verified=True
+            )
+            channel.notify(self.check)
+
+    def deliver_all(self):
+        batch = list(Notification.objects.for_delivery().filter(pending=True))
+        Notification.prefetch_sorts(batch)
+        for notification in batch:
+            notification.deliver()
+
+        return batch
+
+    def test_reads_do_not_grow_with_recipients(self, em):
+        for n in (1, 10):
+            self.queue(n)
+            # Three reads for the whole batch (notifications, check
+            # listing, sort preferences) and two writes per delivery
+            with self.assertNumQueries(3 + 2 * n):
+                batch = self.deliver_all()
+
+            self.assertEqual(len(batch), n)
+            self.assertEqual(em.return_value.alert.call_count, n)
+            em.reset_mock()
+
+    def test_it_uses_prefetched_sort_preference(self, em):
+        Channel.objects.create(
+            project=self.project, kind="email", value="alice@example.org", email_verified=True
+        ).notify(self.check)
+
+        self.deliver_all()
+
+        context = em.return_value.alert.call_args[0][1]
+        self.assertEqual(context["sort"], "name")
+        self.assertEqual(len(context["checks"]), 2)
+
+
+class EmailDeliveryTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        render_cache.clear()
+
+        self.profile.sort = "name"
+        self.profile.save()
+        self.check = Check.objects.create(project=self.project, name="backup", status="down")
+        Check.objects.create(project=self.project, name="Alpha")
+        self.channels = [
+            Channel.objects.create(
+                project=self.project, kind="email", value=email, email_verified=True
+            )
+            for email in ("alice@example.org", "bob@example.org")
+        ]
+
+    def test_it_renders_and_sends(self):
+        for channel in self.channels:
+            self.assertEqual(channel.notify(self.check).deliver(), "")
+
+        # Let the email pool send everything it has queued
+        pool.close(timeout=5)
+
+        self.assertEqual(len(mail.outbox), 2)
+        messages = {msg.to[0]: msg for msg in mail.outbox}
+        # Sorted by name, as alice prefers, or else by creation time
+        self.assertRegex(messages["alice@example.org"].body, r"(?s)Alpha.*backup")
+        self.assertRegex(messages["bob@example.org"].body, r"(?s)backup.*Alpha")
+
+        for channel in self.channels:
+            msg = messages[channel.email_value]
+            self.assertEqual(msg.subject, "DOWN | backup")
+
+            # The shared render got each recipient's own link
+            link = channel.get_unsub_link()
+            self.assertIn(link, msg.body)
+
+            # An absolute https URL, for one-click unsubscribe
+            token = Signer(salt="alerts").sign(str(channel.code))
+            url = "https://example.com/unsubscribe/%s/" % token
+            self.assertEqual(msg.extra_headers["List-Unsubscribe"], "<%s>" % url)
+            self.assertEqual(
+                msg.extra_headers["List-Unsubscribe-Post"], "List-Unsubscribe=One-Click"
+            )
+
+    def deliver_all(self):
+        for notification in Notification.objects.filter(pending=True):
+            self.assertEqual(notification.deliver(), "")
+
+    def test_status_changes_do_not_share_renders(self):
+        carol = Channel.objects.create(
+            project=self.project, kind="email", value="carol@example.org", email_verified=True
+        )
+        for channel in self.channels + [carol]:
+            channel.checks.add(self.check)
+
+        self.check.status = "up"
+        self.check.save()
+
+        with patch.object(Email, "_render", wraps=Email._render) as render:
+            self.check.flip("down")
+            self.deliver_all()
+            # bob and carol both sort by creation time and share a render
+            self.assertEqual(render.call_count, 2)
+
+            self.check.flip("up")
+            self.deliver_all()
+
+            Check.objects.filter(name="Alpha").update(name="Omega")
+            self.check.flip("down")
+            self.deliver_all()
+            self.assertEqual(render.call_count, 6)
+
+        pool.close(timeout=5)
+
+        # The second outage's emails list the checks as they are now
+        bodies = [m.body for m in mail.outbox if m.to == ["bob@example.org"]]
+        bodies = [body for body in bodies if "backup" in body and "DOWN" in body]
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(sorted("Omega" in body for body in bodies), [False, True])
+
+    def test_unsubscribe_link_works(self):
+        channel = self.channels[0]
+        path = urlsplit(channel.get_unsub_link()).path
+
+        r = self.client.get(path)
+        self.assertContains(r, "alice@example.org")
+        self.assertTrue(Channel.objects.filter(id=channel.id).exists())
+
+        self.client.post(path)
+        self.assertFalse(Channel.objects.filter(id=channel.id).exists())
+
+    def test_unsubscribe_checks_signature(self):
+        r = self.client.post("/unsubscribe/%s:bad/" % self.channels[0].code)
+        self.assertEqual(r.status_code, 400)
+
+
+class SiteCacheTestCase(TestCase):
+    def test_local_cache_reloads_periodically(self):
+        site_cache = SiteCache()
+        site_cache.shared = False
+        self.assertEqual(site_cache.get().domain, "example.com")
+
+        # Changed by another process: no signal here
+        Site.objects.update(domain="example.org")
+        self.assertEqual(site_cache.get().domain, "example.com")
+
+        site_cache.checked = 0.0
+        self.assertEqual(site_cache.get().domain, "example.org")
+
+    def test_shared_cache_follows_version_key(self):
+        site_cache = SiteCache()
+        site_cache.shared = True
+        site_cache.get()
+
+        Site.objects.update(domain="example.org")
+        site_cache.checked = 0.0
+        self.assertEqual(site_cache.get().domain, "example.com")
+
+        # What a Site save in another process does
+        cache.set(sites.VERSION_KEY, uuid4().hex)
+        site_cache.checked = 0.0
+        self.assertEqual(site_cache.get().domain, "example.org")
+
+
+class UnsupportedChannelTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(project=self.project, status="up")
+        self.channel = Channel.objects.create(project=self.project, kind="sms", value="+123")
+        self.channel.checks.add(self.check)
+
+    def test_sendalerts_records_error(self):
+        self.check.alert_after = timezone.now() - timedelta(minutes=1)
+        self.check.save()
+
+        call_command("sendalerts", "--no-loop", stdout=StringIO())
+
+        self.check.refresh_from_db()
+        self.assertEqual(self.check.status, "down")
+
+        notification = Notification.objects.get()
+        self.assertFalse(notification.pending)
+        self.assertEqual(notification.error, "Unsupported channel kind: sms")
+
+    @patch("hc.buffers.pings")
+    def test_ping_flips_and_records_error(self, pings):
+        r = self.client.get("/ping/%s/fail" % self.check.code)
+        self.assertEqual(r.status_code, 200)
+
+        self.check.refresh_from_db()
+        self.assertEqual(self.check.status, "down")
+        self.assertEqual(Notification.objects.get().error, "Unsupported channel kind: sms")
+
+
+class NotifyWorkerTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(project=self.project, status="down")
+        self.worker = NotifyWorker()
+
+    def queue(self, kind, n=1):
+        value = json.dumps({"cmd_down": "true", "cmd_up": ""}) if kind == "shell" else "a@b.c"
+        channel = Channel.objects.create(project=self.project, kind=kind, value=value)
+        return [channel.notify(self.check) for i in range(n)]
+
+    def test_it_leases_only_free_slots(self):
+        shell = self.queue("shell", 3)
+        email = self.queue("email")
+
+        batch = self.worker.lease(10, {"shell": 1})
+        self.assertEqual([n.id for n in batch], [shell[0].id, email[0].id])
+
+        # Shell is full now, the other shell rows stay queued
+        self.assertEqual(self.worker.lease(10, {"shell": 0}), [])
+        self.assertEqual(len(self.worker.lease(10)), 2)
+
+    def test_it_releases_expired_leases(self):
+        n = self.queue("shell")[0]
+        self.assertEqual(len(self.worker.lease(10)), 1)
+        self.assertEqual(self.worker.lease(10), [])
+
+        Notification.objects.filter(id=n.id).update(
+            lease_until=timezone.now() - timedelta(seconds=1)
+        )
+        batch = self.worker.lease(10)
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(Notification.objects.get(id=n.id).attempts, 2)
+
+    def test_it_skips_notifications_taken_over(self):
+        self.queue("shell")
+        stale = self.worker.lease(10)[0]
+
+        # The lease ran out and another worker took the row
+        Notification.objects.update(lease_until=timezone.now() - timedelta(seconds=1))
+        fresh = self.worker.lease(10)[0]
+
+        self.assertFalse(self.worker.renew(stale))
+        self.assertTrue(self.worker.renew(fresh))
+
+    @override_settings(NOTIFY_MAX_ATTEMPTS=2)
+    def test_it_gives_up(self):
+        n = self.queue("shell")[0]
+        Notification.objects.filter(id=n.id).update(attempts=2)
+
+        self.worker.deliver(self.worker.lease(10)[0])
+        n.refresh_from_db()
+        self.assertFalse(n.pending)
+        self.assertEqual(n.error, "Gave up after 2 attempts")
+
+    @override_settings(NOTIFY_MAX_ATTEMPTS=2)
+    @patch("django.core.mail.backends.locmem.EmailBackend.send_messages")
+    def test_it_retries_failed_emails(self, send_messages):
+        send_messages.side_effect = SMTPException("Connection refused")
+        self.check.channel_set.add(
+            Channel.objects.create(
+                project=self.project, kind="email", value="a@b.c", email_verified=True
+            )
+        )
+        self.check.send_alert()
+
+        self.worker.deliver(self.worker.lease(10)[0])
+        n = Notification.objects.get()
+        # Still queued, and the reason is on record
+        self.assertTrue(n.pending)
+        self.assertEqual(n.error, "Failed to send email: Connection refused")
+        self.assertEqual(n.channel.last_error, n.error)
+
+        for i in range(2):
+            # The lease runs out, and the next attempt comes along
+            Notification.objects.update(lease_until=timezone.now() - timedelta(seconds=1))
+            self.worker.deliver(self.worker.lease(10)[0])
+
+        n.refresh_from_db()
+        self.assertFalse(n.pending)
+        self.assertEqual(n.error, "Gave up after 2 attempts: Failed to send email: Connection refused")
+        self.assertEqual(send_messages.call_count, 2)
+
+    def test_it_delivers(self):
+        n = self.queue("shell")[0]
+        self.worker.deliver(self.worker.lease(10)[0])
+
+        n.refresh_from_db()
+        self.assertFalse(n.pending)
+        self.assertIsNone(n.lease_until)
+        self.assertEqual(n.error, "")
+
+
+class IndexUsageTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(project=self.project)
+        self.channel = Channel.objects.create(project=self.project, kind="email")
+
+        if connection.vendor == "postgresql":
+            # The test tables are tiny, make sure the planner doesn't
+            # prefer a sequential scan just because of that
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, q, name):
+        plan = q.explain()
+        self.assertRegex(plan, r"\b%s\b" % name)
+
+    def test_pings_by_id_use_index(self):
+        q = Ping.objects.filter(owner=self.check).order_by("-id")[:10]
+        self.assertUsesIndex(q, "hc_ping_owner_ping_id")
+
+    def test_pings_by_time_use_index(self):
+        q = Ping.objects.filter(owner=self.check, created_at__gte=timezone.now())
+        self.assertUsesIndex(q, "hc_ping_owner_created_at")
+
+    def test_latest_notification_uses_index(self):
+        q = Notification.objects.filter(channel=self.channel).order_by("-created_at")[:1]
+        self.assertUsesIndex(q, "hc_notification_chan_created")
+
+    def test_latest_notification_works(self):
+        self.assertIsNone(self.channel.latest_notification())
+
+        earlier = Notification.objects.create(
+            owner=self.check, channel=self.channel, check_status="up"
+        )
+        earlier.created_at = timezone.now() - timedelta(minutes=1)
+        earlier.save()
+
+        latest = Notification.objects.create(
+            owner=self.check, channel=self.channel, check_status="down"
+        )
+        self.assertEqual(self.channel.latest_notification(), latest)
+
+    def test_project_checks_use_index(self):
+        q = self.project.check_set.order_by("created_at")
+        self.assertUsesIndex(q, "hc_check_project_created_at")
+
+
+class AdminSearchTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        bob = User.objects.create(username="bob", email="bob@example.org")
+        bob_project = Project.objects.create(owner=Profile.objects.create(user=bob))
+
+        self.backup = Check.objects.create(project=self.project, name="nightly backup")
+        self.report = Check.objects.create(project=self.project, name="nightly report")
+        self.bob = Check.objects.create(project=bob_project, name="weekly backup")
+        self.model_admin = ChecksAdmin(Check, admin.site)
+
+    def search(self, term):
+        q, distinct = self.model_admin.get_search_results(None, Check.objects.all(), term)
+        self.assertFalse(distinct)
+        return set(q)
+
+    def test_every_word_has_to_match(self):
+        self.assertEqual(self.search("backup"), {self.backup, self.bob})
+        self.assertEqual(self.search("nightly backup"), {self.backup})
+        self.assertEqual(self.search("  backup   weekly "), {self.bob})
+        self.assertEqual(self.search("nightly monthly"), set())
+
+    def test_quoted_words_stay_together(self):
+        self.assertEqual(self.search('"y backup"'), {self.backup, self.bob})
+        self.assertEqual(self.search('"backup nightly"'), set())
+
+    def test_blank_term_matches_all(self):
+        self.assertEqual(self.search(" "), {self.backup, self.report, self.bob})
+
+    def test_uuid_matches_code_exactly(self):
+        self.assertEqual(self.search(str(self.report.code)), {self.report})
+        self.assertEqual(self.search(str(uuid4())), set())
+
+    def test_uuid_in_other_fields_is_not_matched(self):
+        code = str(uuid4())
+        self.bob.name = "restore %s" % code
+        self.bob.save()
+
+        self.assertEqual(self.search(code), set())
+
+    def test_related_fields_use_subquery(self):
+        self.assertEqual(self.search("bob@"), {self.bob})
+        self.assertEqual(self.search("alice@ report"), {self.report})
+
+        q, _ = self.model_admin.get_search_results(None, Check.objects.all(), "bob@")
+        sql = str(q.query)
+        self.assertIn('IN (SELECT U0."id" FROM "auth_user"', sql)
+        self.assertNotIn('JOIN "auth_user"', sql)
+
+
+class EstimatedCountPaginatorTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        Check.objects.bulk_create([Check(project=self.project) for i in range(5)])
+        self.q = Check.objects.order_by("id")
+
+    def paginator(self, q, threshold=3):
+        paginator = EstimatedCountPaginator(q, 2)
+        paginator.threshold = threshold
+        return paginator
+
+    def test_it_counts_up_to_threshold(self):
+        self.assertEqual(self.paginator(self.q).count, 3)
+
+        cache.clear()
+        self.assertEqual(self.paginator(self.q, threshold=100).count, 5)
+
+    def test_it_caches_counts(self):
+        self.assertEqual(self.paginator(self.q, threshold=100).count, 5)
+        Check.objects.create(project=self.project)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.paginator(self.q, threshold=100).count, 5)
+
+        # A different filter is a different cache key
+        q = self.q.filter(project=self.project)
+        self.assertEqual(self.paginator(q, threshold=100).count, 6)
+
+    def test_it_handles_empty_querysets_and_lists(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.paginator(self.q.filter(id__in=[])).count, 0)
+            self.assertEqual(self.paginator([1, 2, 3, 4]).count, 4)
+
+    @patch("hc.admin.connection")
+    def test_it_uses_planner_estimate(self, connection):
+        connection.vendor = "postgresql"
+        with patch.object(EstimatedCountPaginator, "_estimate", return_value=12345):
+            self.assertEqual(self.paginator(self.q).count, 12345)
+
+    @patch("hc.admin.connection")
+    def test_it_counts_exactly_below_threshold(self, connection):
+        connection.vendor = "postgresql"
+        with patch.object(EstimatedCountPaginator, "_estimate", return_value=2):
+            self.assertEqual(self.paginator(self.q).count, 5)
+
+    @patch("hc.admin.connection")
+    def test_it_counts_exactly_when_explain_fails(self, connection):
+        connection.vendor = "postgresql"
+        error = DatabaseError("boom")
+        with patch.object(EstimatedCountPaginator, "_estimate", side_effect=error):
+            self.assertEqual(self.paginator(self.q).count, 5)
+
+    @skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_estimate_reads_plan_rows(self):
+        sql, params = self.q.query.sql_with_params()
+        self.assertGreaterEqual(self.paginator(self.q)._estimate(sql, params), 1)
+
+
+class ChannelsAdminTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_user = User.objects.create_superuser("admin", "admin@example.org", "pw")
+        self.client.force_login(admin_user)
+
+    def add_channels(self, n):
+        for i in range(n):
+            Channel.objects.create(project=self.project, kind="email", value="%d@example.org" % i)
+
+    def get_changelist(self):
+        # Counts are cached by EstimatedCountPaginator
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            r = self.client.get("/admin/hc/channel/")
+
+        self.assertEqual(r.status_code, 200)
+        return r, [q["sql"] for q in ctx.captured_queries if '"hc_channel"' in q["sql"]]
+
+    def test_changelist_renders(self):
+        self.add_channels(1)
+        r, queries = self.get_changelist()
+
+        self.assertContains(r, "alice@example.org")
+        self.assertContains(r, "/admin/hc/check/?project__id__exact=%d" % self.project.id)
+
+        # The changelist follows that link's lookup
+        r = self.client.get("/admin/hc/check/?project__id__exact=%d" % self.project.id)
+        self.assertEqual(r.status_code, 200)
+
+    def test_changelist_queries_do_not_grow(self):
+        self.add_channels(1)
+        r, few = self.get_changelist()
+
+        self.add_channels(20)
+        r, many = self.get_changelist()
+
+        # One paginator count, one query for the page of channels
+        self.assertEqual(len(few), 2)
+        self.assertEqual(len(many), 2)
+        self.assertNotIn("hc_notification", " ".join(many))
+
+
+class ChecksAdminTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_user = User.objects.create_superuser("admin", "admin@example.org", "pw")
+        self.client.force_login(admin_user)
+        self.check = Check.objects.create(project=self.project, name="nightly backup", tags="db")
+
+    def get_changelist(self, query=""):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            r = self.client.get("/admin/hc/check/" + query)
+
+        self.assertEqual(r.status_code, 200)
+        return r, ctx.captured_queries
+
+    def test_changelist_renders(self):
+        r, queries = self.get_changelist()
+
+        link = '<a href="/admin/hc/check/%d/change/">nightly backup</a>' % self.check.id
+        self.assertContains(r, link)
+        self.assertContains(r, "<span>db</span>")
+        self.assertContains(r, "alice@example.org &rsaquo;")
+        self.assertContains(r, "/admin/hc/check/?project__id__exact=%d" % self.project.id)
+
+    def test_changelist_queries_do_not_grow(self):
+        r, few = self.get_changelist()
+
+        Check.objects.bulk_create([Check(project=self.project) for i in range(20)])
+        r, many = self.get_changelist()
+        self.assertEqual(len(few), len(many))
+
+    def test_search_splits_words(self):
+        Check.objects.create(project=self.project, name="weekly backup")
+
+        r, queries = self.get_changelist("?q=backup+nightly")
+        self.assertContains(r, "nightly backup")
+        self.assertNotContains(r, "weekly backup")
+
+        r, queries = self.get_changelist("?q=%s" % self.check.code)
+        self.assertContains(r, "nightly backup")
+
+
+class PingTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        registry.invalidate()
+
+        self.check = Check.objects.create(project=self.project, status="up")
+        # The flusher thread never gets to run, the tests flush explicitly
+        self.buffer = PingBuffer(size=100, window=3600)
+        patcher = patch("hc.buffers.pings", self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_it_records_pings(self):
+        url = "/ping/%s" % self.check.code
+        self.client.post(url + "/start", "hello", content_type="text/plain")
+        self.client.get(url + "/fail")
+        self.client.get(url, HTTP_X_FORWARDED_FOR="1.2.3.4, 5.6.7.8")
+        self.assertEqual(self.buffer.flush(), 3)
+
+        pings = list(Ping.objects.order_by("id"))
+        self.assertEqual([p.count for p in pings], [1, 2, 3])
+        self.assertEqual([p.kind for p in pings], ["start", "fail", None])
+        self.assertEqual(pings[0].get_body(), "hello")
+        self.assertEqual(pings[2].remote_addr, "1.2.3.4")
+
+        self.check.refresh_from_db()
+        self.assertEqual(self.check.status, "up")
+        self.assertEqual(self.check.ping_count, 3)
+        self.assertIsNone(self.check.last_start)
+
+        rollup = Rollup.objects.get(owner=self.check, period="hour")
+        self.assertEqual((rollup.n_pings, rollup.n_fails, rollup.n_durations), (3, 1, 1))
+
+    def test_counts_are_unique_across_buffers(self):
+        # Two web processes, each with its own buffer
+        other = PingBuffer(size=100, window=3600)
+        for i in range(6):
+            with patch("hc.buffers.pings", other if i % 2 else self.buffer):
+                self.client.get("/ping/%s" % self.check.code)
+
+        other.flush()
+        self.buffer.flush()
+        counts = sorted(Ping.objects.values_list("count", flat=True))
+        self.assertEqual(counts, [1, 2, 3, 4, 5, 6])
+
+    def test_it_flushes_when_full(self):
+        self.buffer.size = 2
+        self.client.get("/ping/%s" % self.check.code)
+        self.assertEqual(Ping.objects.count(), 0)
+
+        self.client.get("/ping/%s" % self.check.code)
+        self.assertEqual(Ping.objects.count(), 2)
+
+    def test_failed_flush_does_not_fail_the_ping(self):
+        self.buffer.size = 2
+        self.client.get("/ping/%s" % self.check.code)
+
+        with patch.object(PingBuffer, "_write", side_effect=DatabaseError("boom")):
+            with self.assertLogs("hc.buffers", "ERROR"):
+                r = self.client.get("/ping/%s" % self.check.code)
+
+        self.assertEqual(r.status_code, 200)
+
+    def test_pings_of_deleted_checks_are_dropped(self):
+        gone = Check.objects.create(project=self.project)
+        self.check.ping("1.2.3.4", "http", "GET", "", "", "success")
+        gone.ping("1.2.3.4", "http", "GET", "", "", "success")
+
+        # On a real commit, the deferred foreign key check would fail
+        real, calls = Ping.objects.bulk_create, []
+
+        def bulk_create(objs):
+            calls.append(objs)
+            if len(calls) == 1:
+                raise IntegrityError("FOREIGN KEY constraint failed")
+            return real(objs)
+
+        gone.delete()
+        with patch.object(Ping.objects, "bulk_create", bulk_create):
+            self.buffer.flush()
+
+        self.assertEqual([len(objs) for objs in calls], [2, 1])
+        self.assertEqual(list(Ping.objects.values_list("owner", flat=True)), [self.check.id])
+
+    @patch("hc.models.can_return_from_update", lambda conn: False)
+    def test_it_numbers_pings_without_returning(self):
+        for i in range(2):
+            self.check.ping("1.2.3.4", "http", "GET", "", "", "success")
+        self.buffer.flush()
+
+        counts = sorted(Ping.objects.values_list("count", flat=True))
+        self.assertEqual(counts, [1, 2])
+
+    def test_flip_queues_alerts(self):
+        channel = Channel.objects.create(project=self.project, kind="email", value="a@b.c")
+        channel.checks.add(self.check)
+
+        self.client.get("/ping/%s/fail" % self.check.code)
+        notification = Notification.objects.get()
+        self.assertEqual(notification.check_status, "down")
+        self.assertTrue(notification.pending)
+
+        self.client.get("/ping/%s" % self.check.code)
+        self.assertEqual(Notification.objects.filter(check_status="up").count(), 1)
+
+    def test_new_checks_come_up_quietly(self):
+        self.check.status = "new"
+        self.check.save()
+        channel = Channel.objects.create(project=self.project, kind="email", value="a@b.c")
+        channel.checks.add(self.check)
+
+        self.client.get("/ping/%s" % self.check.code)
+        self.check.refresh_from_db()
+        self.assertEqual(self.check.status, "up")
+        self.assertFalse(Notification.objects.exists())
+
+
+@override_settings(PING_BODY_COMPRESS_THRESHOLD=10)
+class PingBodyTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(project=self.project)
+
+    def test_short_bodies_stay_inline(self):
+        ping = Ping(owner=self.check)
+        for body in ("", None, "aaaaaaaaaa"):
+            self.assertFalse(ping.set_body(body))
+            self.assertEqual((ping.body, ping.body_raw), (body, None))
+
+    def test_long_bodies_are_compressed(self):
+        body = "hello wörld " * 20
+        ping = Ping(owner=self.check)
+        self.assertTrue(ping.set_body(body))
+        self.assertIsNone(ping.body)
+        self.assertLess(len(ping.body_raw), len(body))
+
+        ping.save()
+        ping = Ping.objects.get(id=ping.id)
+        self.assertEqual(ping.get_body(), body)
+
+    def test_incompressible_bodies_stay_inline(self):
+        # Too short and varied for zlib to make any shorter
+        body = "abcdefghijklmnop"
+        ping = Ping(owner=self.check)
+        self.assertFalse(ping.set_body(body))
+        self.assertEqual((ping.body, ping.body_raw), (body, None))
+        self.assertEqual(ping.get_body(), body)
+
+    def test_compresspings_converts_existing_pings(self):
+        long_body = "hello " * 20
+        pings = [
+            Ping.objects.create(owner=self.check, body=body)
+            for body in (long_body, "short", "abcdefghijklmnop", long_body)
+        ]
+
+        out = StringIO()
+        result = call_command("compresspings", "--chunk-size", "1", stdout=out)
+        self.assertEqual(result, "Done! Compressed 2 ping(s)")
+        # One ping per chunk; none is shorter than the threshold / 4
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len([line for line in lines if line.startswith("Processed")]), 4)
+
+        stored = [Ping.objects.get(id=ping.id) for ping in pings]
+        self.assertEqual([p.body_raw is not None for p in stored], [True, False, False, True])
+        self.assertEqual([p.get_body() for p in stored], [p.body for p in pings])
+
+
+@override_settings(PING_BODY_COMPRESS_THRESHOLD=10)
+class ExportTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(project=self.project)
+        other = Check.objects.create(project=self.project)
+
+        self.day = datetime(2020, 1, 2, tzinfo=timezone.utc)
+        for i, body in enumerate(["hello", "hello wörld " * 20]):
+            ping = Ping(owner=self.check, count=i + 1, created_at=self.day + timedelta(hours=i))
+            ping.set_body(body)
+            ping.save()
+        Ping.objects.create(owner=other, created_at=self.day)
+        Ping.objects.create(owner=self.check, created_at=self.day - timedelta(days=1))
+
+    def export(self, *args):
+        out = StringIO()
+        call_command("export", "pings", *args, stdout=out)
+        return out.getvalue()
+
+    def test_command_writes_csv(self):
+        out = self.export("--check", str(self.check.code), "--since", "2020-01-02")
+
+        rows = list(csv.DictReader(StringIO(out)))
+        self.assertEqual([row["n"] for row in rows], ["1", "2"])
+        self.assertEqual(rows[0]["check"], str(self.check.code))
+        self.assertEqual(rows[0]["created_at"], "2020-01-02T00:00:00+00:00")
+        # Compressed bodies come out as text
+        self.assertEqual(rows[1]["body"], "hello wörld " * 20)
+        self.assertNotIn("body_raw", rows[0])
+
+    def test_command_writes_jsonl(self):
+        out = self.export("--format", "jsonl", "--until", "2020-01-02T00:30:00")
+
+        rows = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]["body"], "hello")
+        self.assertEqual(rows[-1]["created_at"], "2020-01-01T00:00:00+00:00")
+
+    def test_command_rejects_bad_timestamps(self):
+        with self.assertRaisesMessage(CommandError, "Bad timestamp: yesterday"):
+            self.export("--since", "yesterday")
+
+    def test_view_streams_export(self):
+        admin_user = User.objects.create_superuser("admin", "admin@example.org", "pw")
+        self.client.force_login(admin_user)
+
+        url = "/export/pings/?format=jsonl&since=2020-01-02&check=%s" % self.check.code
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["Content-Disposition"], 'attachment; filename="pings.jsonl"')
+
+        lines = b"".join(r.streaming_content).decode().splitlines()
+        bodies = [json.loads(line)["body"] for line in lines]
+        self.assertEqual(bodies, ["hello", "hello wörld " * 20])
+
+        r = self.client.get("/export/notifications/")
+        header = b"".join(r.streaming_content).decode().splitlines()[0]
+        self.assertEqual(header, "id,check,created_at,check_status,channel,channel_kind,error")
+
+        self.assertEqual(self.client.get("/export/pings/?since=soon").status_code, 400)
+        self.assertEqual(self.client.get("/export/pings/?format=xml").status_code, 400)
+
+    def test_view_is_for_staff(self):
+        r = self.client.get("/export/pings/")
+        self.assertEqual(r.status_code, 302)
+
+
+@override_settings(PING_LOG_LIMIT=3, PING_LOG_LIMIT_PAID=5)
+class PruneTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = self.add_check(self.project, 8)
+
+        # bob is on a paid plan and keeps more
+        bob = User.objects.create(username="bob", email="bob@example.org")
+        profile = Profile.objects.create(user=bob)
+        plan = Plan.objects.create(name="Supporter", sku="supporter", is_supporter=True)
+        Subscription.objects.create(profile=profile, plan=plan)
+        self.paid = self.add_check(Project.objects.create(owner=profile), 8)
+
+    def add_check(self, project, n):
+        check = Check.objects.create(project=project, ping_count=n)
+        Ping.objects.bulk_create([Ping(owner=check, count=i + 1) for i in range(n)])
+        return check
+
+    def counts(self, check):
+        q = Ping.objects.filter(owner=check).order_by("count")
+        return list(q.values_list("count", flat=True))
+
+    def test_prunepings_keeps_the_plans_limit(self):
+        result = call_command("prunepings", "--chunk-size", "2", stdout=StringIO())
+
+        self.assertEqual(result, "Deleted 8 pings")
+        self.assertEqual(self.counts(self.check), [6, 7, 8])
+        self.assertEqual(self.counts(self.paid), [4, 5, 6, 7, 8])
+
+    def test_it_deletes_in_chunks(self):
+        command = PrunePings()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(command.prune(self.check.id, 3, 2, False), 5)
+
+        deletes = [q for q in ctx.captured_queries if q["sql"].startswith("DELETE")]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(self.counts(self.check), [6, 7, 8])
+
+    def test_dry_run_deletes_nothing(self):
+        result = call_command("prunepings", "--dry-run", stdout=StringIO())
+
+        self.assertEqual(result, "Would delete 8 pings")
+        self.assertEqual(Ping.objects.count(), 16)
+
+    def test_prunepings_skips_checks_under_the_minimum_limit(self):
+        # Never received more pings than any plan keeps
+        few = self.add_check(self.project, 3)
+        Ping.objects.bulk_create([Ping(owner=few, count=0) for i in range(2)])
+
+        call_command("prunepings", stdout=StringIO())
+        self.assertEqual(len(self.counts(few)), 5)
+
+    def test_prunenotifications_keeps_the_plans_limit(self):
+        channel = Channel.objects.create(project=self.project, kind="email")
+        for i in range(4):
+            Notification.objects.create(owner=self.check, channel=channel, check_status="down")
+        newest = Notification.objects.order_by("-id")[:3]
+        newest = list(newest.values_list("id", flat=True))
+
+        result = call_command("prunenotifications", stdout=StringIO())
+        self.assertEqual(result, "Deleted 1 notifications")
+        remaining = Notification.objects.order_by("-id").values_list("id", flat=True)
+        self.assertEqual(list(remaining), newest)
+
+
+class RollupTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(project=self.project, status="up")
+        self.day = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    def rollup(self, period, start):
+        return Rollup.objects.get(owner=self.check, period=period, start=start)
+
+    def test_apply_creates_then_adds(self):
+        for durations in ([2.0], [1.0, 5.0], []):
+            totals = rollups.Totals()
+            totals.pings = totals.fails = 1
+            totals.durations = durations
+            rollups._apply(self.check.id, "day", self.day, totals)
+
+        r = self.rollup("day", self.day)
+        self.assertEqual((r.n_pings, r.n_fails, r.n_durations), (3, 3, 3))
+        self.assertEqual((r.min_duration, r.max_duration), (1.0, 5.0))
+        self.assertEqual(r.avg_duration(), 8.0 / 3)
+
+    def test_downtime_is_split_by_period(self):
+        since = self.day + timedelta(hours=23, minutes=30)
+        until = self.day + timedelta(days=1, hours=1, minutes=15)
+        rollups.record_downtime(self.check.id, since, until)
+
+        hours = Rollup.objects.filter(period="hour").order_by("start")
+        self.assertEqual([r.downtime for r in hours], [1800, 3600, 900])
+        self.assertEqual(self.rollup("day", self.day).downtime, 1800)
+        self.assertEqual(self.rollup("day", self.day + timedelta(days=1)).downtime, 4500)
+
+    def test_summary_includes_ongoing_outage(self):
+        rollups.record_downtime(self.check.id, self.day, self.day + timedelta(hours=6))
+        self.check.down_since = self.day + timedelta(days=1, hours=18)
+
+        until = self.day + timedelta(days=2)
+        result = rollups.summary(self.check, self.day, until)
+        self.assertEqual(result["downtime"], 12 * 3600)
+        self.assertEqual(result["uptime"], 0.75)
+
+    def test_pings_update_rows_in_key_order(self):
+        other = Check.objects.create(project=self.check.project)
+        times = [self.day + timedelta(hours=2), self.day, self.day + timedelta(hours=1)]
+        pings = [Ping(owner=check, created_at=t) for t in times for check in (other, self.check)]
+
+        with patch("hc.rollups._apply") as apply:
+            rollups.record_pings(pings)
+
+        keys = [c[0][:3] for c in apply.call_args_list]
+        self.assertEqual(len(keys), 8)
+        self.assertEqual(keys, sorted(keys))
+
+    @patch("hc.rollups._apply", side_effect=DatabaseError("deadlock detected"))
+    def test_rollup_failure_keeps_pings(self, apply):
+        buffer = PingBuffer(size=100, window=3600)
+        buffer.add(Ping(owner=self.check, created_at=self.day))
+        with self.assertLogs("hc.buffers", "ERROR"):
+            buffer.flush()
+
+        self.assertEqual(Ping.objects.count(), 1)
+        self.assertFalse(Rollup.objects.exists())
+
+    def test_rebuild_keeps_pruned_history(self):
+        times = [self.day + timedelta(minutes=i) for i in range(3)]
+        times += [self.day + timedelta(days=1, minutes=i) for i in range(3)]
+        later = self.day + timedelta(days=1, hours=5)
+        times.append(later)
+        pings = [
+            Ping.objects.create(owner=self.check, count=i + 1, created_at=t)
+            for i, t in enumerate(times)
+        ]
+        rollups.record_pings(pings)
+
+        # prunepings has removed the first day's pings and one more
+        Ping.objects.filter(count__lte=4).delete()
+        Rollup.objects.filter(period="hour", start=later).update(n_pings=100)
+        call_command("rebuildrollups", stdout=StringIO())
+
+        self.assertEqual(self.rollup("day", self.day).n_pings, 3)
+        # Partly pruned, so left alone as well
+        self.assertEqual(self.rollup("day", self.day + timedelta(days=1)).n_pings, 4)
+        self.assertEqual(self.rollup("hour", self.day + timedelta(days=1)).n_pings, 3)
+        # Wholly covered by stored pings, so recomputed
+        self.assertEqual(self.rollup("hour", later).n_pings, 1)
+
+    def test_rebuild_recomputes_complete_history(self):
+        pings = [
+            Ping.objects.create(owner=self.check, count=i + 1, created_at=self.day)
+            for i in range(3)
+        ]
+        rollups.record_pings(pings)
+        Rollup.objects.update(n_pings=100)
+
+        call_command("rebuildrollups", stdout=StringIO())
+        self.assertEqual(self.rollup("day", self.day).n_pings, 3)
+        self.assertEqual(self.rollup("hour", self.day).n_pings, 3)
+
+
+@skipUnless(connection.vendor == "postgresql", "Partitioning needs PostgreSQL")
+class PartitionTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(project=self.project)
+        self.now = datetime(2020, 3, 15, tzinfo=timezone.utc)
+
+    def test_it_converts_and_rotates(self):
+        old = Ping.objects.create(owner=self.check, created_at=self.now - timedelta(days=60))
+
+        partitions.convert("month", self.now)
+        self.assertTrue(partitions.is_partitioned())
+        self.assertTrue(Ping.objects.filter(id=old.id).exists())
+
+        created = partitions.create_partitions("month", 1, self.now)
+        self.assertEqual(created, ["hc_ping_p202004", "hc_ping_p202005"])
+
+        # New rows go to the new partitions, and ids carry on
+        new = Ping.objects.create(owner=self.check, created_at=self.now + timedelta(days=30))
+        self.assertGreater(new.id, old.id)
+
+        dropped = partitions.drop_partitions(self.now + timedelta(days=17))
+        self.assertEqual(dropped, [partitions.LEGACY])
+        self.assertEqual(list(Ping.objects.values_list("id", flat=True)), [new.id])
+
+
+class PingRegistryTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        registry.invalidate()
+        self.check = Check.objects.create(project=self.project, status="up")
+
+    def test_receivers_connect_at_startup(self):
+        # A fresh process, like a management command, that never loads
+        # the URLconf
+        code = (
+            "import django, sys; django.setup(); "
+            "from django.db.models.signals import post_save; "
+            "from hc.models import Check; "
+            "print('hc.views' in sys.modules, post_save.has_listeners(Check))"
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="health.settings")
+        out = subprocess.run(
+            [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+        )
+        self.assertEqual(out.stdout.split(), ["False", "True"])
+
+    @patch("hc.buffers.pings")
+    def test_unchanged_status_takes_one_update(self, pings):
+        registry.get(self.check.code)
+
+        with self.assertNumQueries(1):
+            r = self.client.get("/ping/%s" % self.check.code)
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(pings.add.call_count, 1)
+        self.check.refresh_from_db()
+        self.assertEqual(self.check.ping_count, 1)
+        self.assertIsNotNone(self.check.alert_after)
+
+    @patch("hc.buffers.pings")
+    def test_status_change_takes_full_path(self, pings):
+        self.client.get("/ping/%s/fail" % self.check.code)
+
+        self.check.refresh_from_db()
+        self.assertEqual(self.check.status, "down")
+        self.assertIsNotNone(self.check.down_since)
+
+    def test_unknown_codes_are_cached(self):
+        url = "/ping/%s" % uuid4()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_local_cache_bounds_staleness(self):
+        with override_settings(CHECK_REGISTRY_CHECK_INTERVAL=5):
+            with patch("hc.registry.cache_is_shared", lambda: False):
+                local = CheckRegistry(10, 300, 30)
+            with patch("hc.registry.cache_is_shared", lambda: True):
+                shared = CheckRegistry(10, 300, 30)
+
+        self.assertEqual((local.ttl, local.negative_ttl), (5, 5))
+        self.assertEqual((shared.ttl, shared.negative_ttl), (300, 30))
+
+    def test_saving_a_check_invalidates(self):
+        self.assertEqual(registry.get(self.check.code).kind, "simple")
+
+        self.check.kind = "cron"
+        self.check.save()
+        self.assertEqual(registry.get(self.check.code).kind, "cron")
+
+
+class SnapshotStatusTestCase(BaseTestCase):
+    def test_it_matches_model_status(self):
+        self.profile.timezone = "Europe/Riga"
+        self.profile.save()
+
+        now = timezone.now()
+        for minutes in (0, 30, 90, 24 * 60 + 30, 24 * 60 + 90):
+            last_ping = now - timedelta(minutes=minutes)
+            Check.objects.create(project=self.project, status="up", last_ping=last_ping)
+            Check.objects.create(
+                project=self.project, status="up", last_ping=last_ping, kind="cron", schedule="0 * * * *"
+            )
+        Check.objects.create(project=self.project, status="up", last_start=now - timedelta(hours=2))
+        Check.objects.create(project=self.project)
+        Check.objects.create(project=self.project, status="paused", last_ping=now - timedelta(days=9))
+
+        q = Check.objects.filter(project=self.project)
+        expected = {check.id: check.get_status(now) for check in q}
+        self.assertEqual(statuses(q, now), expected)
+        self.assertEqual(set(expected.values()), {"new", "paused", "up", "grace", "down"})
+
+
+def reference_replace(template, ctx):
+    """ The original split-on-"$" algorithm, with longest-match semantics. """
+
+    parts = template.split("$")
+    result = [parts.pop(0)]
+    for part in parts:
+        part = "$" + part
+        for placeholder in sorted(ctx, key=len, reverse=True):
+            if part.startswith(placeholder):
+                part = part.replace(placeholder, ctx[placeholder], 1)
+                break
+        result.append(part)
+
+    return "".join(result)
+
+
+CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def reference_field(s, lo, hi):
+    values = set()
+    for part in s.split(","):
+        part, _, step = part.partition("/")
+        step = int(step or 1)
+        if part == "*":
+            start, end = lo, hi
+        elif "-" in part:
+            start, end = map(int, part.split("-"))
+        else:
+            start = int(part)
+            end = hi if step > 1 else start
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+def reference_days(expression):
+    """ Return a day filter, and the matching times of day in order. """
+
+    parts = expression.split()
+    minutes, hours, doms, months, dows = [
+        reference_field(part, lo, hi) for part, (lo, hi) in zip(parts, CRON_RANGES)
+    ]
+    dows = {dow % 7 for dow in dows}
+    both = parts[2].startswith("*") or parts[4].startswith("*")
+
+    def matches(day):
+        dom, dow = day.day in doms, day.isoweekday() % 7 in dows
+        return day.month in months and ((dom and dow) if both else (dom or dow))
+
+    times = [time(h, m) for h in sorted(hours) for m in sorted(minutes)]
+    return matches, times
+
+
+def reference_next(expression, after):
+    matches, times = reference_days(expression)
+    day = after.date()
+    while True:
+        if matches(day):
+            for t in times:
+                dt = datetime.combine(day, t)
+                if dt > after:
+                    return dt
+        day += timedelta(days=1)
+
+
+def reference_prev(expression, before):
+    matches, times = reference_days(expression)
+    day = before.date()
+    while True:
+        if matches(day):
+            for t in reversed(times):
+                dt = datetime.combine(day, t)
+                if dt < before:
+                    return dt
+        day -= timedelta(days=1)
+
+
+def random_field(rng, lo, hi):
+    a, b = sorted(rng.sample(range(lo, hi + 1), 2))
+    return rng.choice(
+        [
+            "*",
+            "*/%d" % rng.randint(2, 7),
+            str(a),
+            "%d-%d" % (a, b),
+            "%d,%d" % (a, b),
+            "%d-%d/%d" % (a, b, rng.randint(2, 3)),
+            "%d/%d" % (a, rng.randint(2, 5)),
+        ]
+    )
+
+
+class CronTestCase(TestCase):
+    def utc(self, *args):
+        return datetime(*args, tzinfo=timezone.utc)
+
+    def test_it_parses(self):
+        schedule = CronSchedule("*/15 9-17 * * mon-fri")
+        self.assertEqual(schedule.next(self.utc(2020, 1, 3, 17, 50)), self.utc(2020, 1, 6, 9))
+        self.assertEqual(schedule.prev(self.utc(2020, 1, 6, 9)), self.utc(2020, 1, 3, 17, 45))
+
+        # Aliases, names and Sunday as 7
+        self.assertEqual(CronSchedule("@weekly").next(self.utc(2020, 1, 1)), self.utc(2020, 1, 5))
+        weekly = CronSchedule("0 0 * JAN 7")
+        self.assertEqual(weekly.next(self.utc(2020, 1, 1)), self.utc(2020, 1, 5))
+
+    def test_it_rejects_bad_expressions(self):
+        samples = ("* * * *", "60 * * * *", "*/0 * * * *", "* * * foo *", "* * 30 2 *")
+        for expression in samples:
+            with self.assertRaises(ValueError):
+                CronSchedule(expression)
+
+    def test_restricted_day_fields_match_either(self):
+        schedule = CronSchedule("0 0 13 * mon")
+        # Wednesday the 1st: Monday the 6th comes first, then the 13th
+        self.assertEqual(schedule.next(self.utc(2020, 1, 1)), self.utc(2020, 1, 6))
+        self.assertEqual(schedule.next(self.utc(2020, 2, 11)), self.utc(2020, 2, 13))
+
+    def test_star_day_field_matches_both(self):
+        # Mondays that are odd days of the month
+        schedule = CronSchedule("0 0 */2 * mon")
+        self.assertEqual(schedule.next(self.utc(2020, 1, 1)), self.utc(2020, 1, 13))
+        self.assertEqual(schedule.next(self.utc(2020, 1, 13)), self.utc(2020, 1, 27))
+
+        schedule = CronSchedule("0 0 1 * */2")
+        # The 1st, on Sunday, Tuesday, Thursday or Saturday
+        self.assertEqual(schedule.next(self.utc(2020, 1, 2)), self.utc(2020, 2, 1))
+
+    def test_skipped_times_fire_after_the_jump(self):
+        schedule = CronSchedule("30 3 * * *", "Europe/Riga")
+        # On 2020-03-29 clocks jump from 03:00 to 04:00 (01:00 UTC)
+        self.assertEqual(schedule.next(self.utc(2020, 3, 28, 12)), self.utc(2020, 3, 29, 1))
+        self.assertEqual(schedule.next(self.utc(2020, 3, 29, 1)), self.utc(2020, 3, 30, 0, 30))
+
+    def test_repeated_times_fire_twice(self):
+        schedule = CronSchedule("30 3 * * *", "Europe/Riga")
+        # On 2020-10-25 clocks go back from 04:00 to 03:00 (01:00 UTC)
+        first = schedule.next(self.utc(2020, 10, 24, 12))
+        self.assertEqual(first, self.utc(2020, 10, 25, 0, 30))
+        second = schedule.next(first)
+        self.assertEqual(second, self.utc(2020, 10, 25, 1, 30))
+        self.assertEqual(schedule.next(second), self.utc(2020, 10, 26, 1, 30))
+
+        self.assertEqual(schedule.prev(second), first)
+
+    def test_it_matches_reference_on_random_input(self):
+        rng = random.Random(0)
+        tested = 0
+        while tested < 300:
+            expression = " ".join(random_field(rng, lo, hi) for lo, hi in CRON_RANGES)
+            try:
+                schedule = CronSchedule(expression)
+            except ValueError:
+                # Never fires, the reference would search forever
+                continue
+
+            start = datetime(2020, 1, 1) + timedelta(minutes=rng.randint(0, 2 * 365 * 1440))
+            expected = reference_next(expression, start)
+            found = schedule.next(start.replace(tzinfo=timezone.utc))
+            self.assertEqual(found.replace(tzinfo=None), expected, expression)
+
+            expected = reference_prev(expression, start)
+            found = schedule.prev(start.replace(tzinfo=timezone.utc))
+            self.assertEqual(found.replace(tzinfo=None), expected, expression)
+            tested += 1
+
+
+class ReplaceTestCase(TestCase):
+    def test_it_works(self):
+        self.assertEqual(replace("$NAME is down", {"$NAME": "foo"}), "foo is down")
+        self.assertEqual(replace("no placeholders", {"$NAME": "foo"}), "no placeholders")
+        self.assertEqual(replace("$NAME", {}), "$NAME")
+
+    def test_it_ignores_variable_variables(self):
+        ctx = {"$FOO": "$BAR", "$BAR": "World"}
+        self.assertEqual(replace("Hello $FOO", ctx), "Hello $BAR")
+
+        ctx = {"$FOO": "BAR", "$BAR": "World"}
+        self.assertEqual(replace("Hello $$FOO", ctx), "Hello $BAR")
+
+    def test_longest_placeholder_wins(self):
+        ctx = {"$TAG%d" % i: "t%d" % i for i in range(1, 12)}
+        self.assertEqual(replace("$TAG1 $TAG10 $TAG11 $TAG12", ctx), "t1 t10 t11 t12")
+
+    def test_it_matches_reference_on_random_input(self):
+        rng = random.Random(0)
+        alphabet = "$AB1 x"
+        for i in range(2000):
+            keys = {"$" + "".join(rng.choices("AB1", k=rng.randint(0, 3))) for j in range(4)}
+            ctx = {key: "".join(rng.choices(alphabet, k=rng.randint(0, 4))) for key in keys}
+            template = "".join(rng.choices(alphabet, k=rng.randint(0, 20)))
+
+            self.assertEqual(replace(template, ctx), reference_replace(template, ctx))
+
+
+class Response(object):
+    """ Stands in for a requests response; Http.get_error() shows it. """
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def __str__(self):
+        return "oops"
+
+
+@override_settings(HTTP_ATTEMPTS=4, HTTP_BACKOFF=0.5)
+@patch("hc.transport.time.sleep")
+@patch("hc.transport.get_session")
+class HttpRetryTestCase(TestCase):
+    def respond(self, session, status_code):
+        session.return_value.request.return_value = Response(status_code)
+
+    def test_it_retries_server_errors(self, session, sleep):
+        self.respond(session, 500)
+        error = Http.get("http://example.org")
+
+        self.assertEqual(error, 'Received status code 500 with a message: "oops"')
+        self.assertEqual(session.return_value.request.call_count, 4)
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_it_does_not_retry_client_errors(self, session, sleep):
+        self.respond(session, 404)
+        self.assertEqual(Http.get("http://example.org")[:24], "Received status code 404")
+        self.assertEqual(session.return_value.request.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_it_retries_rate_limits(self, session, sleep):
+        self.respond(session, 429)
+        Http.post("http://example.org", data="hi")
+        self.assertEqual(session.return_value.request.call_count, 4)
+
+    def test_it_retries_timeouts_and_connection_errors(self, session, sleep):
+        for exc, message in [
+            (requests.exceptions.ReadTimeout, "Connection timed out"),
+            (requests.exceptions.ConnectionError, "Connection failed"),
+        ]:
+            session.reset_mock()
+            session.return_value.request.side_effect = exc
+            self.assertEqual(Http.get("http://example.org"), message)
+            self.assertEqual(session.return_value.request.call_count, 4)
+
+    def test_it_stops_after_success(self, session, sleep):
+        request = session.return_value.request
+        request.side_effect = [Response(503), Response(200)]
+        self.assertIsNone(Http.put("http://example.org"))
+        self.assertEqual(request.call_count, 2)
+
+    def test_it_sends_timeouts_and_user_agent(self, session, sleep):
+        self.respond(session, 200)
+        with override_settings(HTTP_CONNECT_TIMEOUT=2, HTTP_READ_TIMEOUT=7):
+            Http.get("http://example.org")
+
+        kwargs = session.return_value.request.call_args[1]
+        self.assertEqual(kwargs["timeout"], (2, 7))
+        self.assertEqual(kwargs["headers"]["User-Agent"], get_site().name)
+
+    def test_backoff_grows_exponentially(self, session, sleep):
+        self.respond(session, 500)
+        with patch("hc.transport.random.uniform", side_effect=lambda lo, hi: hi) as uniform:
+            Http.get("http://example.org")
+
+        # Full jitter: anywhere from 0 up to a bound that doubles
+        self.assertEqual([c[0] for c in uniform.call_args_list], [(0, 0.5), (0, 1.0), (0, 2.0)])
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1.0, 2.0])
+
+
+class ShellTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = Check.objects.create(
+            project=self.project, name="it's; `rm -rf /`", tags="foo bar", status="down"
+        )
+
+    def notify(self, cmd):
+        value = json.dumps({"cmd_down": cmd, "cmd_up": ""})
+        channel = Channel.objects.create(project=self.project, kind="shell", value=value)
+        return channel.transport.notify(self.check)
+
+    def test_it_passes_values_in_environment(self):
+        cmd = 'test "$NAME" = "it\'s; \\`rm -rf /\\`" && test "$TAG2" = bar && test $STATUS = down'
+        self.assertIsNone(self.notify(cmd))
+
+    def test_it_reports_exit_code_and_output(self):
+        error = self.notify("echo $CODE; exit 3")
+        self.assertEqual(error, "Command returned exit code 3: %s" % self.check.code)
+
+    @patch.object(runner, "timeout", 0.2)
+    def test_it_kills_slow_commands(self):
+        error = self.notify("sleep 10 & sleep 10")
+        self.assertTrue(error.startswith("Command timed out"))
+
+
+class MetricsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+
+    @patch.object(metrics, "enabled", False)
+    def test_it_records_nothing_when_disabled(self):
+        self.assertIs(metrics.timer("hc_ping_seconds"), NULL_TIMER)
+        metrics.inc("hc_pings_total", path="quick")
+        self.assertEqual(metrics.render(), "\n")
+
+    @patch.object(metrics, "enabled", True)
+    def test_it_renders_cumulative_buckets(self):
+        metrics.observe("hc_shell_seconds", 0.001)
+        metrics.observe("hc_shell_seconds", 0.003)
+        metrics.inc("hc_pings_total", path='a"b')
+
+        lines = metrics.render().splitlines()
+        self.assertIn('hc_pings_total{path="a\\"b"} 1', lines)
+        self.assertIn('hc_shell_seconds_bucket{le="0.001"} 1', lines)
+        self.assertIn('hc_shell_seconds_bucket{le="0.005"} 2', lines)
+        self.assertIn('hc_shell_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("hc_shell_seconds_count 2", lines)
+
+    @patch.object(metrics, "enabled", True)
+    def test_it_renders_gauges(self):
+        self.assertIn("hc_email_queue_depth 0", metrics.render().splitlines())
+
+    @override_settings(METRICS_ENABLED=True, METRICS_TOKEN="secret")
+    @patch.object(metrics, "enabled", True)
+    @patch("hc.buffers.pings")
+    def test_endpoint_serves_ping_metrics(self, pings):
+        check = Check.objects.create(project=self.project)
+        self.client.get("/ping/%s" % check.code)
+
+        r = self.client.get("/metrics")
+        self.assertEqual(r.status_code, 403)
+
+        r = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'hc_ping_seconds_count{action="success"} 1', r.content)
+
+    @override_settings(METRICS_TOKEN="secret")
+    @patch.object(metrics, "enabled", False)
+    def test_server_checks_token(self):
+        server = serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.assertEqual(server.server_address[0], "127.0.0.1")
+
+        url = "http://127.0.0.1:%d/" % server.server_port
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(url)
+        self.assertEqual(cm.exception.code, 403)
+
+        request = Request(url, headers={"Authorization": "Bearer secret"})
+        with urlopen(request) as r:
+            self.assertEqual(r.status, 200)
+
+    @patch.object(metrics, "enabled", False)
+    def test_commands_serve_metrics(self):
+        for name in ("sendalerts", "notifyworker"):
+            servers = []
+
+            def start(*args):
+                servers.append(serve(*args))
+                return servers[-1]
+
+            with patch("hc.management.commands.%s.serve" % name, side_effect=start):
+                call_command(name, "--no-loop", "--metrics-port", "0", stdout=StringIO())
+
+            server = servers[0]
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+
+            # Serving turned metrics on
+            self.assertTrue(metrics.enabled)
+            with urlopen("http://127.0.0.1:%d/" % server.server_port) as r:
+                self.assertEqual(r.status, 200)
+
+        self.assertIn("hc_sendalerts_flips_total 0", metrics.render())
+
+    def test_endpoint_is_off_by_default(self):
+        r = self.client.get("/metrics")
+        self.assertEqual(r.status_code, 404)
+
+
+class BenchTestCase(TestCase):
+    def test_it_refuses_to_run_without_debug(self):
+        with self.assertRaises(CommandError):
+            call_command("scanbench", "--steps", "10", stdout=StringIO())
+
+        self.assertFalse(User.objects.exists())
+
+    def test_it_cleans_up(self):
+        call_command("scanbench", "--steps", "10", "--repeat", "1", "--force", stdout=StringIO())
+        self.assertFalse(Check.objects.exists())
+
+        with self.assertRaises(KeyboardInterrupt):
+            with scratch_project("bench") as project:
+                Check.objects.create(project=project)
+                raise KeyboardInterrupt
+
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Check.objects.exists())
@@ -1,13 +1,21 @@
 import os
+import random
+import time
+from concurrent import futures
+from functools import lru_cache
+from http.cookiejar import DefaultCookiePolicy
 
+from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils import timezone
 import requests
-from hc.emails import Email as em
+from requests.adapters import HTTPAdapter
+from hc.emails import Email as em, render_cache
 from accounts.models import Profile
 from hc.enums import Status
-from hc.utils import replace
-from django.contrib.sites.models import Site
+from hc.metrics import metrics
+from hc.shell import runner
+from hc.sites import get_site
 
 
 def tmpl(template_name, **context):
@@ -17,6 +25,10 @@ def tmpl(template_name, **context):
     return render_to_string(template_path, context).strip().replace("\xa0", " ")
 
 
+class TransientError(Exception):
+    """ A delivery failure that may go away on retry. """
+
+
 class Transport(object):
     def __init__(self, channel):
         self.channel = channel
@@ -39,11 +51,22 @@ class Transport(object):
         return False
 
     def checks(self):
-        return self.channel.project.check_set.order_by("created_at")
+        project = self.channel.project
+        # Notification.objects.for_delivery() prefetches the listing
+        if hasattr(project, "checks_by_created"):
+            return project.checks_by_created
+
+        return project.check_set.order_by("created_at")
 
 
 class Email(Transport):
-    def notify(self, check, bounce_url):
+    def notify(self, check, bounce_url, queued_at):
+        """ Send the email and wait for the SMTP server to accept it.
+
+        Raises TransientError if it doesn't, so the notification stays
+        queued and notifyworker tries again.
+        """
+
         if not self.channel.email_verified:
             return "Email not verified"
 
@@ -55,25 +78,40 @@ class Email(Transport):
             "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
         }
 
-        try:
-            # Look up the sorting preference for this email address
-            p = Profile.objects.get(user__email=self.channel.email_value)
-            sort = p.sort
-        except Profile.DoesNotExist:
-            # Default sort order is by check's creation time
-            sort = "created"
-
-        # list() executes the query, to avoid DB access while
-        # rendering a template
+        # Notification.prefetch_sorts() looks these up for a whole batch
+        sort = getattr(self.channel, "recipient_sort", None)
+        if sort is None:
+            try:
+                # Look up the sorting preference for this email address
+                p = Profile.objects.get(user__email=self.channel.email_value)
+                sort = p.sort
+            except Profile.DoesNotExist:
+                # Default sort order is by check's creation time
+                sort = "created"
+
+        # All recipients of this status change share the check listing
+        # and, per sort order, the rendered email. The notifications of
+        # one status change are queued together, so queued_at tells it
+        # apart from the check's earlier ones. list() executes the
+        # query, to avoid DB access while rendering a template.
+        event = (check.id, check.status, queued_at)
+        checks = render_cache.get_or_set(("checks",) + event, lambda: list(self.checks()))
+
         context = {
             "check": check,
-            "checks": list(self.checks()),
+            "checks": checks,
             "sort": sort,
             "now": timezone.now(),
             "unsub_link": unsub_link,
         }
 
-        em().alert(self.channel.email_value, context, headers)
+        future = em().alert(self.channel.email_value, context, headers, cache_key=event + (sort,))
+        try:
+            future.result(timeout=settings.EMAIL_SEND_TIMEOUT)
+        except futures.TimeoutError:
+            raise TransientError("Timed out sending email")
+        except Exception as e:
+            raise TransientError("Failed to send email: %s" % e)
 
     def is_noop(self, check):
         if check.status == Status.down.name:
@@ -83,20 +121,28 @@ class Email(Transport):
 
 
 class Shell(Transport):
-    def prepare(self, template, check):
+    def get_env(self, check):
+        """ Return the environment for the channel's commands.
 
-        context = {
-            "$CODE": str(check.code),
-            "$STATUS": check.status,
-            "$NOW": timezone.now().replace(microsecond=0).isoformat(),
-            "$NAME": check.name,
-            "$TAGS": check.tags,
+        Commands read the check's details from environment variables
+        ($CODE, $STATUS, $NOW, $NAME, $TAGS and $TAG1, $TAG2, ...), so
+        the shell expands them and they are never parsed as shell
+        syntax, whatever the check's name or tags contain.
+        """
+
+        env = {
+            "PATH": os.environ.get("PATH", os.defpath),
+            "CODE": str(check.code),
+            "STATUS": check.status,
+            "NOW": timezone.now().replace(microsecond=0).isoformat(),
+            "NAME": check.name,
+            "TAGS": check.tags or "",
         }
 
         for i, tag in enumerate(check.tags_list()):
-            context["$TAG%d" % (i + 1)] = tag
+            env["TAG%d" % (i + 1)] = tag
 
-        return replace(template, context)
+        return env
 
     def is_noop(self, check):
         if check.status == Status.down.name and not self.channel.cmd_down:
@@ -113,11 +159,40 @@ class Shell(Transport):
         elif check.status == Status.down.name:
             cmd = self.channel.cmd_down
 
-        cmd = self.prepare(cmd, check)
-        code = os.system(cmd)
+        code, output = runner.run(cmd, self.get_env(check), self.channel.project_id)
+        if code is None:
+            error = "Command timed out after %gs" % runner.timeout
+        elif code != 0:
+            error = "Command returned exit code %d" % code
+        else:
+            return None
+
+        if output:
+            error += ": " + output[-150:]
+
+        return error
+
+
+@lru_cache(maxsize=1)
+def get_session():
+    """ Return the process-wide session used for HTTP delivery.
+
+    The session keeps a pool of keep-alive connections per host, so
+    consecutive webhooks to the same host reuse TCP and TLS sessions.
+    With pool_block the pool also caps concurrent connections per host.
+    Cookies are never stored, so deliveries stay independent.
+    """
 
-        if code != 0:
-            return "Command returned exit code %d" % code
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=settings.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+        pool_block=True,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
 
 
 class Http(Transport):
@@ -127,56 +202,72 @@ class Http(Transport):
 
     @classmethod
     def _request(cls, method, url, **kwargs):
+        """ Make a single attempt and return an error message, or None.
+
+        The second return value tells whether another attempt may help.
+        """
+
+        with metrics.timer("hc_http_request_seconds"):
+            error, retry = cls._attempt(method, url, **kwargs)
+
+        if error is None:
+            metrics.inc("hc_http_requests_total", outcome="ok")
+        else:
+            metrics.inc("hc_http_requests_total", outcome="retry" if retry else "error")
+
+        return error, retry
+
+    @classmethod
+    def _attempt(cls, method, url, **kwargs):
         try:
             options = dict(kwargs)
-            options["timeout"] = 5
+            options["timeout"] = (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
             if "headers" not in options:
                 options["headers"] = {}
             if "User-Agent" not in options["headers"]:
-                options["headers"]["User-Agent"] = Site.objects.first().name
+                options["headers"]["User-Agent"] = get_site().name
 
-            r = requests.request(method, url, **options)
+            r = get_session().request(method, url, **options)
             if r.status_code not in (200, 201, 202, 204):
+                # Other client errors will not go away on retry
+                retry = r.status_code >= 500 or r.status_code == 429
+
                 m = cls.get_error(r)
                 if m:
-                    return f'Received status code {r.status_code} with a message: "{m}"'
+                    return f'Received status code {r.status_code} with a message: "{m}"', retry
 
-                return f"Received status code {r.status_code}"
+                return f"Received status code {r.status_code}", retry
 
         except requests.exceptions.Timeout:
-            return "Connection timed out"
+            return "Connection timed out", True
         except requests.exceptions.ConnectionError:
-            return "Connection failed"
+            return "Connection failed", True
+
+        return None, False
 
     @classmethod
-    def get(cls, url, **kwargs):
+    def _request_with_retries(cls, method, url, **kwargs):
         error = None
-        # Make 3 attempts--
-        for x in range(0, 3):
-            error = cls._request("get", url, **kwargs)
-            if error is None:
+        for attempt in range(settings.HTTP_ATTEMPTS):
+            if attempt:
+                # Exponential backoff with full jitter, so endpoints that
+                # fail together are not retried in lockstep
+                time.sleep(random.uniform(0, settings.HTTP_BACKOFF * 2 ** (attempt - 1)))
+
+            error, retry = cls._request(method, url, **kwargs)
+            if not retry:
                 break
 
         return error
 
     @classmethod
-    def post(cls, url, **kwargs):
-        error = None
-        # Make 3 attempts--
-        for x in range(0, 3):
-            error = cls._request("post", url, **kwargs)
-            if error is None:
-                break
+    def get(cls, url, **kwargs):
+        return cls._request_with_retries("get", url, **kwargs)
 
-        return error
+    @classmethod
+    def post(cls, url, **kwargs):
+        return cls._request_with_retries("post", url, **kwargs)
 
     @classmethod
     def put(cls, url, **kwargs):
-        error = None
-        # Make 3 attempts--
-        for x in range(0, 3):
-            error = cls._request("put", url, **kwargs)
-            if error is None:
-                break
-
-        return error
+        return cls._request_with_retries("put", url, **kwargs)
@@ -0,0 +1,12 @@
+from django.urls import path
+from hc import views
+
+urlpatterns = [
+    path("ping/<uuid:code>", views.ping, name="hc-ping"),
+    path("ping/<uuid:code>/", views.ping, name="hc-ping-slash"),
+    path("ping/<uuid:code>/start", views.ping, {"action": "start"}, name="hc-start"),
+    path("ping/<uuid:code>/fail", views.ping, {"action": "fail"}, name="hc-fail"),
+    path("unsubscribe/<str:token>/", views.unsubscribe_alerts, name="hc-unsubscribe-alerts"),
+    path("metrics", views.metrics, name="hc-metrics"),
+    path("export/<str:kind>/", views.export, name="hc-export"),
+]
@@ -1,3 +1,62 @@
+import re
+from functools import lru_cache
+
+from django.conf import settings
+
+# Cache backends whose contents other processes can't see
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.dummy.DummyCache",
+    "django.core.cache.backends.locmem.LocMemCache",
+)
+
+
+def cache_is_shared():
+    """ Return True if other processes see what is stored in the default cache. """
+
+    return settings.CACHES["default"]["BACKEND"] not in LOCAL_CACHE_BACKENDS
+
+
+def _trie_regex(node):
+    """ Turn a character trie into a regex that matches its longest key.
+
+    Sibling branches start with different characters, so at most one of
+    them can match and the regex never tries a placeholder twice. An
+    optional tail after a complete key is greedy, so longer keys win.
+    """
+
+    branches = [re.escape(ch) + _trie_regex(child) for ch, child in sorted(node.items()) if ch]
+    if not branches:
+        return ""
+
+    body = branches[0] if len(branches) == 1 else "(?:%s)" % "|".join(branches)
+    if "" in node:
+        return "(?:%s)?" % body
+
+    return body
+
+
+@lru_cache(maxsize=256)
+def _pattern(keys):
+    """ Compile a regex matching any placeholder in keys, or return None.
+
+    With both "$TAG1" and "$TAG10" defined, "$TAG10" is not matched as
+    "$TAG1" plus "0".
+    """
+
+    trie = {}
+    for key in keys:
+        if key.startswith("$") and "$" not in key[1:]:
+            node = trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[""] = True
+
+    if not trie:
+        return None
+
+    return re.compile(_trie_regex(trie))
+
+
 def replace(template, ctx):
     """Replace placeholders with their values and return the result.
     Example:
@@ -15,17 +74,20 @@ def replace(template, ctx):
     in the original template. It ignores any placeholders that "emerge"
     during string substitutions. This is done mainly to avoid unexpected
     behavior when check names or tags contain dollar signs.
+    Where several placeholders match, the longest one wins:
+    >>> replace("$TAG10", {"$TAG1": "a", "$TAG10": "b"})
+    b
+    The template is scanned once, with a regex built from a trie of the
+    placeholders and compiled once per distinct set of placeholders.
+    Placeholders are "$" followed by anything but "$"; other keys in
+    ctx are ignored.
     """
 
-    parts = template.split("$")
+    if "$" not in template:
+        return template
 
-    result = [parts.pop(0)]
-    for part in parts:
-        part = "$" + part
-        for placeholder, value in ctx.items():
-            if part.startswith(placeholder):
-                part = part.replace(placeholder, value, 1)
-                break
-        result.append(part)
+    pattern = _pattern(tuple(ctx))
+    if pattern is None:
+        return template
 
-    return "".join(result)
+    return pattern.sub(lambda m: ctx[m.group(0)], template)
@@ -1,3 +1,124 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    StreamingHttpResponse,
+)
+from django.core.signing import BadSignature, Signer
+from django.shortcuts import get_object_or_404, render
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.crypto import constant_time_compare
+from hc import export as exporter
+from hc.metrics import CONTENT_TYPE, metrics as stats
+from hc.models import Channel, Check
+from hc.registry import registry
 
-# Create your views here.
+
+@csrf_exempt
+@never_cache
+def ping(request, code, action="success"):
+    with stats.timer("hc_ping_seconds", action=action):
+        return _ping(request, code, action)
+
+
+def _ping(request, code, action):
+    record = registry.get(code)
+    if record is None:
+        raise Http404()
+
+    headers = request.META
+    remote_addr = headers.get("HTTP_X_FORWARDED_FOR", headers["REMOTE_ADDR"])
+    remote_addr = remote_addr.split(",")[0]
+    scheme = headers.get("HTTP_X_FORWARDED_PROTO", "http")
+    method = headers["REQUEST_METHOD"]
+    ua = headers.get("HTTP_USER_AGENT", "")
+    body = request.body.decode(errors="replace")
+
+    args = (remote_addr, scheme, method, ua, body, action)
+    if Check.quick_ping(record, *args):
+        stats.inc("hc_pings_total", path="quick")
+    else:
+        # The ping changes the status, or there's a pending "start".
+        # The owner's timezone is needed to evaluate cron schedules.
+        q = Check.objects.select_related("project__owner")
+        check = get_object_or_404(q, id=record.id)
+        check.ping(*args)
+        stats.inc("hc_pings_total", path="full")
+
+    response = HttpResponse("OK")
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+@csrf_exempt
+def unsubscribe_alerts(request, token):
+    """ Delete the email channel of a signed unsubscribe link.
+
+    GET only asks for confirmation, so link scanners cannot unsubscribe
+    anybody. Mail clients' one-click unsubscribe POSTs.
+    """
+
+    try:
+        code = Signer(salt="alerts").unsign(token)
+    except BadSignature:
+        return HttpResponseBadRequest()
+
+    channel = get_object_or_404(Channel, code=code, kind="email")
+    if request.method != "POST":
+        return render(request, "unsubscribe.html", {"channel": channel})
+
+    channel.delete()
+    return HttpResponse("Unsubscribed")
+
+
+@never_cache
+def metrics(request):
+    """ Serve this process's metrics in the Prometheus text format. """
+
+    if not settings.METRICS_ENABLED:
+        raise Http404()
+
+    if settings.METRICS_TOKEN:
+        auth = request.META.get("HTTP_AUTHORIZATION", "")
+        if not constant_time_compare(auth, "Bearer %s" % settings.METRICS_TOKEN):
+            return HttpResponseForbidden()
+
+    return HttpResponse(stats.render(), content_type=CONTENT_TYPE)
+
+
+CONTENT_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+@staff_member_required
+def export(request, kind):
+    """ Stream pings or notifications as CSV or JSON Lines.
+
+    Optional query parameters: check and project (codes), since and
+    until (ISO 8601 timestamps or dates) and format (csv or jsonl).
+    """
+
+    if kind not in exporter.MODELS:
+        raise Http404()
+
+    fmt = request.GET.get("format", "csv")
+    if fmt not in exporter.FORMATS:
+        return HttpResponseBadRequest()
+
+    try:
+        q = exporter.get_queryset(
+            kind,
+            check=request.GET.get("check"),
+            project=request.GET.get("project"),
+            since=request.GET.get("since"),
+            until=request.GET.get("until"),
+        )
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    response = StreamingHttpResponse(exporter.lines(kind, q, fmt), content_type=CONTENT_TYPES[fmt])
+    response["Content-Disposition"] = 'attachment; filename="%s.%s"' % (kind, fmt)
+    return response
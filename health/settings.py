@@ -88,6 +88,16 @@ DATABASES = {
     'default': env.db()
 }
 
+# hc.sites and hc.registry keep per-process copies, and learn about
+# changes made in other processes through this cache. With more than
+# one process, point CACHE_URL at a shared backend, for example
+# pymemcache://127.0.0.1:11211 or dbcache://hc_cache (run createcachetable).
+# With the default, process-local cache they re-read the database every
+# few seconds instead.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://')
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -123,4 +133,76 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
-SITE_ID = 1
\ No newline at end of file
+SITE_ID = 1
+# Scheme of the absolute URLs in emails, such as unsubscribe links
+SITE_SCHEME = env('SITE_SCHEME', default='https')
+# Pings are written in batches of up to PING_BUFFER_SIZE rows, and
+# never later than PING_BUFFER_WINDOW seconds after they arrive.
+PING_BUFFER_SIZE = env.int('PING_BUFFER_SIZE', default=100)
+PING_BUFFER_WINDOW = env.float('PING_BUFFER_WINDOW', default=0.5)
+
+# Outgoing HTTP requests (webhooks)
+HTTP_CONNECT_TIMEOUT = env.float('HTTP_CONNECT_TIMEOUT', default=5)
+HTTP_READ_TIMEOUT = env.float('HTTP_READ_TIMEOUT', default=5)
+HTTP_ATTEMPTS = env.int('HTTP_ATTEMPTS', default=3)
+HTTP_BACKOFF = env.float('HTTP_BACKOFF', default=0.5)
+HTTP_POOL_CONNECTIONS = env.int('HTTP_POOL_CONNECTIONS', default=100)
+HTTP_POOL_MAXSIZE = env.int('HTTP_POOL_MAXSIZE', default=10)
+
+# Notification delivery (the notifyworker command). Channel kinds listed
+# in NOTIFY_KIND_CONCURRENCY get at most that many deliveries in flight.
+NOTIFY_WORKERS = env.int('NOTIFY_WORKERS', default=16)
+NOTIFY_KIND_CONCURRENCY = {'shell': 2}
+NOTIFY_LEASE_SECONDS = env.int('NOTIFY_LEASE_SECONDS', default=300)
+NOTIFY_MAX_ATTEMPTS = env.int('NOTIFY_MAX_ATTEMPTS', default=3)
+
+# Outgoing email is sent by EMAIL_POOL_WORKERS threads, each reusing its
+# SMTP connection for batches of up to EMAIL_BATCH_SIZE messages.
+EMAIL_POOL_WORKERS = env.int('EMAIL_POOL_WORKERS', default=4)
+EMAIL_QUEUE_SIZE = env.int('EMAIL_QUEUE_SIZE', default=1000)
+EMAIL_BATCH_SIZE = env.int('EMAIL_BATCH_SIZE', default=20)
+# How long notifyworker waits for the SMTP server to accept an alert
+# before leaving it for a retry.
+EMAIL_SEND_TIMEOUT = env.float('EMAIL_SEND_TIMEOUT', default=60)
+# Seconds during which alert emails for the same status change share a render
+EMAIL_RENDER_CACHE_TTL = env.float('EMAIL_RENDER_CACHE_TTL', default=10)
+
+# How often (in seconds) each process checks whether the Site changed
+SITE_CACHE_CHECK_INTERVAL = env.float('SITE_CACHE_CHECK_INTERVAL', default=5)
+
+# Pings and notifications kept per check by prunepings/prunenotifications
+PING_LOG_LIMIT = env.int('PING_LOG_LIMIT', default=100)
+PING_LOG_LIMIT_PAID = env.int('PING_LOG_LIMIT_PAID', default=1000)
+
+# Range-partition the ping table by created_at ('day' or 'month', PostgreSQL
+# only), how many future partitions to keep ready, and how many days of
+# pings the partitionpings command keeps (0 keeps everything)
+PING_PARTITION_PERIOD = env('PING_PARTITION_PERIOD', default='month')
+PING_PARTITIONS_AHEAD = env.int('PING_PARTITIONS_AHEAD', default=2)
+PING_RETENTION_DAYS = env.int('PING_RETENTION_DAYS', default=0)
+
+# Ping bodies longer than this many bytes are stored zlib-compressed
+PING_BODY_COMPRESS_THRESHOLD = env.int('PING_BODY_COMPRESS_THRESHOLD', default=1000)
+
+# Process-wide cache of check settings by code, used by the ping view.
+# Unknown codes are remembered for CHECK_REGISTRY_NEGATIVE_TTL seconds.
+# Without a shared cache (see CACHE_URL), entries are kept no longer
+# than CHECK_REGISTRY_CHECK_INTERVAL seconds.
+CHECK_REGISTRY_SIZE = env.int('CHECK_REGISTRY_SIZE', default=10000)
+CHECK_REGISTRY_TTL = env.float('CHECK_REGISTRY_TTL', default=300)
+CHECK_REGISTRY_NEGATIVE_TTL = env.float('CHECK_REGISTRY_NEGATIVE_TTL', default=30)
+# How often (in seconds) each process checks whether any check changed
+CHECK_REGISTRY_CHECK_INTERVAL = env.float('CHECK_REGISTRY_CHECK_INTERVAL', default=5)
+
+# Shell notifications: commands are killed after SHELL_TIMEOUT seconds, and
+# each process runs at most SHELL_CONCURRENCY of them at a time, at most
+# SHELL_PROJECT_CONCURRENCY for any one project
+SHELL_TIMEOUT = env.float('SHELL_TIMEOUT', default=30)
+SHELL_CONCURRENCY = env.int('SHELL_CONCURRENCY', default=4)
+SHELL_PROJECT_CONCURRENCY = env.int('SHELL_PROJECT_CONCURRENCY', default=1)
+
+# Per-stage latency histograms and counters, served in the Prometheus text
+# format at /metrics. When METRICS_TOKEN is set, scrapers must send it as
+# a bearer token.
+METRICS_ENABLED = env.bool('METRICS_ENABLED', default=False)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
@@ -33,6 +33,15 @@ class Plan(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def ping_log_limit(self):
+        """ Number of pings and notifications kept per check. """
+
+        if self.is_supporter or self.is_business or self.is_business_plus:
+            return settings.PING_LOG_LIMIT_PAID
+
+        return settings.PING_LOG_LIMIT
+
 
 class SubscriptionManager(models.Manager):
     def for_user(self, user):